@@ -17,22 +17,28 @@ if [ ! -f "target/release/mem-search-service" ]; then
     echo ""
 fi
 
-# Check if service is already running
-if [ -e "/tmp/mem_search_service_requests.sock" ]; then
-    echo "⚠️  Service socket already exists. Cleaning up..."
-    rm /tmp/mem_search_service_requests.sock
-    echo ""
-fi
-
 # Start service in background
 echo "[2] Starting memory search service..."
 ./target/release/mem-search-service &
 SERVICE_PID=$!
 
-# Wait for service to start
-sleep 1
+# Wait until the request socket is listening (up to 3s), instead of a fixed sleep
+service_ready() {
+    if [ -r /proc/net/unix ]; then
+        grep -q '@mem_search_service_requests' /proc/net/unix
+    else
+        [ -S /tmp/mem_search_service_requests.sock ]
+    fi
+}
+
+for _ in $(seq 60); do
+    if service_ready || ! kill -0 $SERVICE_PID 2>/dev/null; then
+        break
+    fi
+    sleep 0.05
+done
 
-if ! kill -0 $SERVICE_PID 2>/dev/null; then
+if ! kill -0 $SERVICE_PID 2>/dev/null || ! service_ready; then
     echo "❌ Service failed to start"
     exit 1
 fi
@@ -50,8 +56,6 @@ echo ""
 echo "[4] Cleaning up..."
 kill $SERVICE_PID 2>/dev/null || true
 wait $SERVICE_PID 2>/dev/null || true
-rm -f /tmp/mem_search_service_requests.sock
-rm -f /tmp/qwen_code_response_*.sock
 
 echo "    ✓ Cleanup complete"
 echo ""
@@ -1,125 +1,1482 @@
 use anyhow::{Context, Result};
-use grep_regex::RegexMatcherBuilder;
-use grep_searcher::sinks::UTF8;
-use grep_searcher::Searcher;
-use memmap2::Mmap;
+use crossbeam_channel::unbounded;
+use grep_regex::{RegexMatcher, RegexMatcherBuilder};
+use grep_searcher::{Searcher, SearcherBuilder, Sink, SinkMatch};
+use ignore::WalkState;
+use log::info;
+use memchr::{memchr, memchr_iter};
+use memmap2::{Advice, Mmap};
 use rayon::prelude::*;
-use std::collections::HashMap;
+use std::collections::{HashMap, HashSet};
 use std::fs::File;
+use std::io::{ErrorKind, Read};
 use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::Arc;
+use std::thread;
+use trigram::TrigramIndex;
+use xxhash_rust::xxh3::Xxh3;
 
-/// Memory-mapped file cache for a single codebase
+mod literal;
+mod trigram;
+
+/// Number of compiled patterns a query cache keeps by default
+pub const QUERY_CACHE_CAPACITY: usize = 256;
+
+/// Source of cache epochs. One counter for the whole process, so an epoch is
+/// never reused, even by a codebase loaded again from the same root.
+static EPOCHS: AtomicU64 = AtomicU64::new(0);
+
+fn next_epoch() -> u64 {
+    EPOCHS.fetch_add(1, Ordering::Relaxed) + 1
+}
+
+/// Compile a search pattern the way every search in this crate expects it.
+///
+/// grep-regex is built on the `regex` crate, which is already a linear-time
+/// automaton engine (no backtracking blow-up on ambiguous patterns) with SIMD
+/// literal prefilters, so the remaining cost worth removing is recompilation.
+pub fn build_matcher(pattern: &str, case_sensitive: bool) -> Result<RegexMatcher> {
+    // Declaring the line terminator lets the searcher run the regex over the
+    // whole mapped buffer in one pass and only look for line boundaries around
+    // actual matches, instead of feeding the matcher one line at a time.
+    RegexMatcherBuilder::new()
+        .case_insensitive(!case_sensitive)
+        .line_terminator(Some(b'\n'))
+        .build(pattern)
+        .context("Invalid regex pattern")
+}
+
+/// A compiled search pattern: the matcher, plus the literals every match must
+/// contain, which let a search skip units through the trigram index
+pub struct Query {
+    pub matcher: RegexMatcher,
+    literals: Vec<Vec<u8>>,
+    /// Lowercased needle when the pattern is a case-insensitive ASCII
+    /// literal, which is searched without the regex engine
+    ascii_literal: Option<Vec<u8>>,
+}
+
+impl Query {
+    pub fn new(pattern: &str, case_sensitive: bool) -> Result<Self> {
+        Ok(Self {
+            matcher: build_matcher(pattern, case_sensitive)?,
+            literals: trigram::required_literals(pattern, case_sensitive),
+            ascii_literal: literal::folded_ascii_literal(pattern, case_sensitive),
+        })
+    }
+}
+
+/// Least-recently-used cache of compiled queries keyed by (pattern, case_sensitive)
+pub struct QueryCache {
+    entries: HashMap<(String, bool), (Arc<Query>, u64)>,
+    capacity: usize,
+    clock: u64,
+}
+
+impl QueryCache {
+    pub fn new(capacity: usize) -> Self {
+        Self {
+            entries: HashMap::new(),
+            capacity: capacity.max(1),
+            clock: 0,
+        }
+    }
+
+    /// Return the compiled query for a pattern, compiling it on first use
+    pub fn get(&mut self, pattern: &str, case_sensitive: bool) -> Result<Arc<Query>> {
+        if let Some(query) = self.lookup(pattern, case_sensitive) {
+            return Ok(query);
+        }
+
+        let query = Arc::new(Query::new(pattern, case_sensitive)?);
+        Ok(self.insert(pattern, case_sensitive, query))
+    }
+
+    /// Return the compiled query for a pattern if it is cached. Together with
+    /// `insert`, this lets a shared cache compile a new pattern without
+    /// holding its lock, so one slow compile does not stall other lookups.
+    pub fn lookup(&mut self, pattern: &str, case_sensitive: bool) -> Option<Arc<Query>> {
+        self.clock += 1;
+        let (query, last_used) = self.entries.get_mut(&(pattern.to_owned(), case_sensitive))?;
+        *last_used = self.clock;
+        Some(Arc::clone(query))
+    }
+
+    /// Add a query compiled outside the cache. If another caller cached the
+    /// same pattern in the meantime, that query is kept and returned.
+    pub fn insert(
+        &mut self,
+        pattern: &str,
+        case_sensitive: bool,
+        query: Arc<Query>,
+    ) -> Arc<Query> {
+        self.clock += 1;
+        let key = (pattern.to_owned(), case_sensitive);
+
+        if let Some((cached, last_used)) = self.entries.get_mut(&key) {
+            *last_used = self.clock;
+            return Arc::clone(cached);
+        }
+
+        if self.entries.len() >= self.capacity {
+            // Evict the least recently used pattern
+            if let Some(oldest) = self
+                .entries
+                .iter()
+                .min_by_key(|(_, (_, last_used))| *last_used)
+                .map(|(key, _)| key.clone())
+            {
+                self.entries.remove(&oldest);
+            }
+        }
+
+        self.entries.insert(key, (Arc::clone(&query), self.clock));
+        query
+    }
+
+    pub fn len(&self) -> usize {
+        self.entries.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.entries.is_empty()
+    }
+}
+
+/// Extensions of binary files, which are never loaded
+const BINARY_EXTENSIONS: &[&str] = &[
+    "png", "jpg", "jpeg", "gif", "pdf", "zip", "tar", "gz", "so", "dylib", "dll", "exe", "bin", "o",
+    "a",
+];
+
+/// Whether a path has a binary extension. Compares the raw extension bytes
+/// case-insensitively, so no lossy UTF-8 conversion or lowercased copy is
+/// allocated per file.
+fn has_binary_extension(path: &Path) -> bool {
+    path.extension().map_or(false, |ext| {
+        let ext = ext.as_encoded_bytes();
+        BINARY_EXTENSIONS
+            .iter()
+            .any(|binary| ext.eq_ignore_ascii_case(binary.as_bytes()))
+    })
+}
+
+/// Directories that are never descended into. Hidden files are searched, but
+/// version control metadata (packfiles, object stores) never holds useful text.
+const SKIPPED_DIRECTORIES: &[&str] = &[".git", ".hg", ".svn"];
+
+fn is_skipped_directory(entry: &ignore::DirEntry) -> bool {
+    entry.file_type().map_or(false, |ft| ft.is_dir())
+        && SKIPPED_DIRECTORIES.iter().any(|dir| entry.file_name() == *dir)
+}
+
+/// Files larger than this are never loaded
+const MAX_FILE_BYTES: u64 = 50 * 1024 * 1024;
+
+/// Files at or below this size are packed into shards rather than searched
+/// through a mapping of their own
+const SHARD_FILE_LIMIT: u64 = 64 * 1024;
+
+/// A shard is closed once it grows past this many bytes
+const SHARD_TARGET_BYTES: usize = 16 * 1024 * 1024;
+
+/// Most large files a cache keeps mapped. Each mapping is a VMA counted
+/// against `vm.max_map_count` (65530 by default) and keeps its pages resident
+/// between searches, so beyond this many, large files are mapped only while a
+/// search or indexing pass is reading them.
+const MAX_MAPPED_FILES: usize = 4096;
+
+/// Many small files concatenated into one buffer, so a single search call
+/// covers all of them instead of paying per-call setup once per file.
+///
+/// Every member starts on a fresh line (a newline is appended to members that
+/// lack one), so a line never spans two files and every match maps back to
+/// exactly one member.
+struct Shard {
+    buf: Vec<u8>,
+    /// Byte offset at which each member starts in `buf`
+    starts: Vec<usize>,
+    /// Shard-relative line number (1-based) on which each member starts
+    first_lines: Vec<u64>,
+    /// File number of each member
+    files: Vec<usize>,
+    /// Members whose file has since changed or been deleted. Their bytes stay
+    /// in `buf`, but matches in them are dropped.
+    removed: Vec<bool>,
+    /// Total size of the removed members
+    removed_bytes: usize,
+    /// Offset of every newline in `buf`
+    newlines: Vec<u32>,
+}
+
+impl Shard {
+    fn new() -> Self {
+        Self {
+            buf: Vec::new(),
+            starts: Vec::new(),
+            first_lines: Vec::new(),
+            files: Vec::new(),
+            removed: Vec::new(),
+            removed_bytes: 0,
+            newlines: Vec::new(),
+        }
+    }
+
+    /// Append a file's contents, reading them straight into the shard buffer
+    fn push_file(&mut self, file_idx: usize, file: &mut File) -> std::io::Result<usize> {
+        let start = self.buf.len();
+        if let Err(e) = file.read_to_end(&mut self.buf) {
+            self.buf.truncate(start);
+            return Err(e);
+        }
+
+        Ok(self.finish_member(file_idx, start))
+    }
+
+    /// Append a member copied from another shard
+    fn push_bytes(&mut self, file_idx: usize, bytes: &[u8]) -> usize {
+        let start = self.buf.len();
+        self.buf.extend_from_slice(bytes);
+        self.finish_member(file_idx, start)
+    }
+
+    /// Record the member whose bytes were just appended at `start`, and
+    /// return its member number
+    fn finish_member(&mut self, file_idx: usize, start: usize) -> usize {
+        if self.buf.last() != Some(&b'\n') {
+            self.buf.push(b'\n');
+        }
+
+        self.starts.push(start);
+        self.first_lines.push(self.newlines.len() as u64 + 1);
+        self.files.push(file_idx);
+        self.removed.push(false);
+        self.newlines.extend(
+            memchr_iter(b'\n', &self.buf[start..]).map(|offset| (start + offset) as u32),
+        );
+
+        self.files.len() - 1
+    }
+
+    /// Bytes of member `member`, including its trailing newline
+    fn member_bytes(&self, member: usize) -> &[u8] {
+        let end = self.starts.get(member + 1).copied().unwrap_or(self.buf.len());
+        &self.buf[self.starts[member]..end]
+    }
+
+    fn remove_member(&mut self, member: usize) {
+        self.removed[member] = true;
+        self.removed_bytes += self.member_bytes(member).len();
+    }
+
+    fn is_full(&self) -> bool {
+        self.buf.len() >= SHARD_TARGET_BYTES
+    }
+
+    /// Whether removed members take up most of the buffer
+    fn is_mostly_removed(&self) -> bool {
+        self.removed_bytes * 2 > self.buf.len()
+    }
+
+    fn unit(&self) -> Unit<'_> {
+        Unit {
+            bytes: &self.buf,
+            starts: &self.starts,
+            first_lines: &self.first_lines,
+            files: &self.files,
+            removed: &self.removed,
+            newlines: &self.newlines,
+        }
+    }
+}
+
+/// Offsets of every newline in `buf`. memchr scans with SIMD, and the result
+/// is kept per unit, so searches resolve line numbers with a binary search per
+/// match instead of counting newlines across the whole buffer every time.
+///
+/// Offsets are stored as u32: files over `MAX_FILE_BYTES` are never loaded and
+/// shards stop just past `SHARD_TARGET_BYTES`, so no unit comes near 4 GiB.
+/// That halves the table and fits twice as many entries per cache line.
+fn newline_offsets(buf: &[u8]) -> Vec<u32> {
+    memchr_iter(b'\n', buf).map(|offset| offset as u32).collect()
+}
+
+/// Pass `reader`'s bytes to `f` in chunks until end of file. Returns the
+/// number of bytes read.
+///
+/// Files being loaded or checked for changes are read this way rather than
+/// through a fresh mapping: the watcher reports files while they are being
+/// rewritten, and reading a mapping of a file truncated underneath it raises
+/// SIGBUS instead of returning an error.
+fn read_chunks(mut reader: impl Read, mut f: impl FnMut(&[u8])) -> std::io::Result<u64> {
+    let mut buf = vec![0u8; 64 * 1024];
+    let mut total = 0;
+    loop {
+        match reader.read(&mut buf) {
+            Ok(0) => return Ok(total),
+            Ok(n) => {
+                f(&buf[..n]);
+                total += n as u64;
+            }
+            Err(e) if e.kind() == ErrorKind::Interrupted => {}
+            Err(e) => return Err(e),
+        }
+    }
+}
+
+/// Newline offsets and hash of a file's contents, and its length, read with
+/// `read_chunks`
+fn scan_file(file: &File) -> std::io::Result<(Vec<u32>, u64, usize)> {
+    let mut newlines = Vec::new();
+    let mut hasher = Xxh3::new();
+    let mut len = 0;
+    read_chunks(file, |chunk| {
+        newlines.extend(memchr_iter(b'\n', chunk).map(|offset| (len + offset) as u32));
+        hasher.update(chunk);
+        len += chunk.len();
+    })?;
+    Ok((newlines, hasher.digest(), len))
+}
+
+/// Backing storage of one searchable unit
+enum Storage {
+    /// A large file searched through its own mapping
+    Mapped {
+        file: usize,
+        mmap: Mmap,
+        newlines: Vec<u32>,
+        /// Hash of the contents when they were indexed. The mapping shows
+        /// in-place writes as they happen, so this is the only record of
+        /// what the index was built from.
+        hash: u64,
+    },
+    /// Small files packed together
+    Shard(Shard),
+    /// A large file past the mapping cap, mapped only while it is read
+    Cold { file: usize },
+    /// Contents that have all been superseded. The slot is kept so later
+    /// units keep their numbers in the trigram index, until dead units are
+    /// dropped (see `drop_dead_units`).
+    Dead,
+}
+
+/// Where a file's current contents are held
+#[derive(Clone, Copy)]
+enum Location {
+    /// Member `member` of unit `unit` (always 0 outside shards)
+    Unit { unit: usize, member: usize },
+    /// Deleted or unreadable since it was first seen
+    Absent,
+}
+
+/// One searchable buffer: either a single mapped file or a whole shard
+struct Unit<'a> {
+    bytes: &'a [u8],
+    starts: &'a [usize],
+    first_lines: &'a [u64],
+    files: &'a [usize],
+    removed: &'a [bool],
+    newlines: &'a [u32],
+}
+
+impl<'a> Unit<'a> {
+    /// A unit holding one whole file
+    fn single(file: &'a usize, bytes: &'a [u8], newlines: &'a [u32]) -> Self {
+        Self {
+            bytes,
+            starts: &[0],
+            first_lines: &[1],
+            files: std::slice::from_ref(file),
+            removed: &[false],
+            newlines,
+        }
+    }
+
+    /// Member holding the byte at `offset`
+    fn member_at(&self, offset: usize) -> usize {
+        self.starts.partition_point(|&start| start <= offset) - 1
+    }
+}
+
+/// A sink for the matches of a query in one unit. Plain case-insensitive
+/// literals are found with the literal scan, anything else with the searcher.
+trait QuerySink: Sink<Error = std::io::Error> + Sized {
+    /// Feed the sink the matches of a folded ASCII literal
+    fn search_literal(&mut self, needle: &[u8]);
+
+    /// Feed the sink the matches of `query` in `bytes`, the sink's unit
+    fn search_query(&mut self, searcher: &mut Searcher, query: &Query, bytes: &[u8]) {
+        match &query.ascii_literal {
+            Some(needle) => self.search_literal(needle),
+            None => {
+                let _ = searcher.search_slice(&query.matcher, bytes, self);
+            }
+        }
+    }
+}
+
+/// Sink that maps each match in a unit back to its member file and line.
+/// The unit may be a short-lived mapping, so it has its own lifetime apart
+/// from the paths the matches borrow.
+struct UnitSink<'u, 'a> {
+    unit: Unit<'u>,
+    rel_paths: &'a [String],
+    matches: Vec<(&'a str, u64, String)>,
+}
+
+impl<'u, 'a> UnitSink<'u, 'a> {
+    /// Record the matching line that starts at `offset`. `line_idx` is the
+    /// number of newlines before it in the unit.
+    fn push_line(&mut self, line_idx: usize, offset: usize, line: &[u8]) {
+        let member = self.unit.member_at(offset);
+        if self.unit.removed[member] {
+            return;
+        }
+        let line_num = line_idx as u64 + 2 - self.unit.first_lines[member];
+
+        // Lossy decoding keeps searching past invalid UTF-8 instead of
+        // abandoning the rest of the file at the first bad line
+        let line = String::from_utf8_lossy(line);
+        self.matches.push((
+            self.rel_paths[self.unit.files[member]].as_str(),
+            line_num,
+            line.trim_end().to_string(),
+        ));
+    }
+}
+
+impl<'u, 'a> QuerySink for UnitSink<'u, 'a> {
+    /// Search the unit for a folded ASCII literal, taking line boundaries
+    /// from the unit's newline offsets
+    fn search_literal(&mut self, needle: &[u8]) {
+        let bytes = self.unit.bytes;
+        let newlines = self.unit.newlines;
+
+        literal::for_each_match(bytes, needle, |at| {
+            let line_idx = newlines.partition_point(|&nl| (nl as usize) < at);
+            let start = match line_idx {
+                0 => 0,
+                i => newlines[i - 1] as usize + 1,
+            };
+            let end = newlines
+                .get(line_idx)
+                .map_or(bytes.len(), |&nl| nl as usize + 1);
+
+            self.push_line(line_idx, start, &bytes[start..end]);
+
+            // Report each line once, however many times it matches
+            end
+        });
+    }
+}
+
+impl<'u, 'a> Sink for UnitSink<'u, 'a> {
+    type Error = std::io::Error;
+
+    fn matched(&mut self, _searcher: &Searcher, mat: &SinkMatch<'_>) -> Result<bool, Self::Error> {
+        let offset = mat.absolute_byte_offset() as usize;
+        let line_idx = self.unit.newlines.partition_point(|&nl| (nl as usize) < offset);
+        self.push_line(line_idx, offset, mat.bytes());
+
+        Ok(true)
+    }
+}
+
+/// Sink that only counts matching lines
+struct CountSink<'u> {
+    unit: Unit<'u>,
+    count: u64,
+}
+
+impl<'u> CountSink<'u> {
+    fn count_line(&mut self, offset: usize) {
+        if !self.unit.removed[self.unit.member_at(offset)] {
+            self.count += 1;
+        }
+    }
+}
+
+impl<'u> QuerySink for CountSink<'u> {
+    /// Count the lines containing the folded ASCII literal `needle`
+    fn search_literal(&mut self, needle: &[u8]) {
+        let bytes = self.unit.bytes;
+        literal::for_each_match(bytes, needle, |at| {
+            self.count_line(at);
+            memchr(b'\n', &bytes[at..]).map_or(bytes.len(), |nl| at + nl + 1)
+        });
+    }
+}
+
+impl<'u> Sink for CountSink<'u> {
+    type Error = std::io::Error;
+
+    fn matched(&mut self, _searcher: &Searcher, mat: &SinkMatch<'_>) -> Result<bool, Self::Error> {
+        self.count_line(mat.absolute_byte_offset() as usize);
+        Ok(true)
+    }
+}
+
+/// A directory walker with the filtering every load uses: `.gitignore` rules
+/// apply, hidden files are included, and version control directories are
+/// pruned before the walker descends into them
+fn walker(dir: &Path) -> ignore::WalkBuilder {
+    let mut builder = ignore::WalkBuilder::new(dir);
+    builder
+        .hidden(false)
+        .git_ignore(true)
+        .git_global(true)
+        .git_exclude(true);
+    builder
+}
+
+/// A file whose contents in a cache changed during `MmapCache::refresh`.
+/// Paths are relative to the cache root, as in search results.
+#[derive(Debug, Clone, PartialEq, Eq)]
+pub enum FileChange {
+    /// The file was loaded, or reloaded with new contents
+    Indexed(String),
+    /// The file was deleted, or can no longer be read
+    Removed(String),
+}
+
+/// Memory-mapped file cache for a single codebase.
+///
+/// Per-file data is stored as parallel vectors indexed by file number rather
+/// than a map keyed by path, so a search walks each array sequentially and
+/// never hashes a path. Large files are searched through their own mapping;
+/// small files are copied into shards. Up to `MAX_MAPPED_FILES` large files
+/// stay mapped, and any further ones are mapped on demand.
+///
+/// The cache can be kept up to date with `refresh`. A changed file is placed
+/// in a new unit (or appended to the open shard) and its old contents are
+/// retired, so unit numbers do not shift under the trigram index, and only
+/// the new content needs indexing. Once retired contents outweigh the live
+/// ones, they are dropped and the index is rebuilt.
 pub struct MmapCache {
-    pub files: HashMap<PathBuf, Mmap>,
     pub root: PathBuf,
+    /// Path of each file ever loaded
+    paths: Vec<PathBuf>,
+    /// Path relative to `root`, as reported in search results
+    rel_paths: Vec<String>,
+    /// File sizes in bytes (0 once a file is absent)
+    sizes: Vec<u64>,
+    /// Where each file's contents are held
+    locations: Vec<Location>,
+    /// File number of each path in `paths`
+    by_path: HashMap<PathBuf, usize>,
+    /// Directories the walk entered, i.e. not ignored
+    dirs: HashSet<PathBuf>,
+    /// Searchable units, in the numbering the trigram index uses
+    units: Vec<Storage>,
+    /// Number of `Storage::Mapped` units, held under `MAX_MAPPED_FILES`
+    mapped_count: usize,
+    /// Shard that new small files are appended to
+    open_shard: Option<usize>,
+    /// Trigrams of every unit. Retired content stays in the postings, which
+    /// only costs a wasted candidate, until dead units are dropped.
+    index: TrigramIndex,
+    /// Size of the dead units, whose trigrams are still in the index
+    dead_bytes: u64,
+    /// Changes whenever a refresh may have changed search results
+    epoch: u64,
 }
 
 impl MmapCache {
     /// Create a new cache by memory-mapping all files in the given directory
     pub fn new(root: &Path) -> Result<Self> {
-        println!("Loading files into memory from: {}", root.display());
-        let mut files = HashMap::new();
-        let mut file_count = 0;
-        let mut total_bytes = 0u64;
-
-        // Use ignore crate to walk directory, respecting .gitignore
-        let walker = ignore::WalkBuilder::new(root)
-            .hidden(false)
-            .git_ignore(true)
-            .git_global(true)
-            .git_exclude(true)
+        info!("Loading files into memory from: {}", root.display());
+        let mut cache = Self {
+            root: root.to_owned(),
+            paths: Vec::new(),
+            rel_paths: Vec::new(),
+            sizes: Vec::new(),
+            locations: Vec::new(),
+            by_path: HashMap::new(),
+            dirs: HashSet::new(),
+            units: Vec::new(),
+            mapped_count: 0,
+            open_shard: None,
+            index: TrigramIndex::new(),
+            dead_bytes: 0,
+            epoch: next_epoch(),
+        };
+
+        // Use ignore crate to walk directory, respecting .gitignore. The walk
+        // runs on its own worker threads, which read directories and match
+        // ignore rules while this thread loads the files already found.
+        let walk = walker(root)
+            .filter_entry(|entry| !is_skipped_directory(entry))
+            .build_parallel();
+        let (entry_tx, entry_rx) = unbounded();
+
+        thread::scope(|scope| {
+            scope.spawn(move || {
+                walk.run(|| {
+                    let entry_tx = entry_tx.clone();
+                    Box::new(move |entry| {
+                        // The loader stops at the first error, or has already
+                        // stopped if the send fails
+                        let failed = entry.is_err();
+                        if entry_tx.send(entry).is_err() || failed {
+                            WalkState::Quit
+                        } else {
+                            WalkState::Continue
+                        }
+                    })
+                });
+            });
+
+            for entry in entry_rx {
+                let entry = entry.context("Failed to read directory entry")?;
+                cache.add_entry(entry);
+            }
+
+            Ok::<_, anyhow::Error>(())
+        })?;
+
+        cache.index = cache.build_index();
+
+        info!(
+            "Loaded {} files ({:.2} MB total) into memory",
+            cache.len(),
+            cache.total_bytes() as f64 / 1024.0 / 1024.0
+        );
+
+        Ok(cache)
+    }
+
+    /// Take in one entry from a directory walk. Returns the file number of
+    /// the file it loaded, if any.
+    fn add_entry(&mut self, entry: ignore::DirEntry) -> Option<usize> {
+        let file_type = entry.file_type()?;
+
+        if file_type.is_dir() {
+            self.dirs.insert(entry.into_path());
+            return None;
+        }
+
+        // Skip binary files
+        if !file_type.is_file() || has_binary_extension(entry.path()) {
+            return None;
+        }
+
+        // Take ownership of the entry's path rather than cloning it
+        self.load_file(entry.into_path())
+    }
+
+    /// Read or map a file and place it in a unit, registering its path on
+    /// first sight. Returns the file number if the file was loaded.
+    fn load_file(&mut self, path: PathBuf) -> Option<usize> {
+        let mut file = File::open(&path).ok()?;
+        let file_size = file.metadata().ok()?.len();
+
+        // Skip very large files and empty files
+        if file_size > MAX_FILE_BYTES || file_size == 0 {
+            return None;
+        }
+
+        let file_idx = self.by_path.get(&path).copied().unwrap_or(self.paths.len());
+        let location = self.place_file(file_idx, &mut file, file_size).ok()?;
+
+        if file_idx == self.paths.len() {
+            let rel_path = path
+                .strip_prefix(&self.root)
+                .unwrap_or(&path)
+                .to_string_lossy()
+                .into_owned();
+
+            self.by_path.insert(path.clone(), file_idx);
+            self.paths.push(path);
+            self.rel_paths.push(rel_path);
+            self.sizes.push(file_size);
+            self.locations.push(location);
+        } else {
+            self.sizes[file_idx] = file_size;
+            self.locations[file_idx] = location;
+        }
+
+        Some(file_idx)
+    }
+
+    /// Put a file's contents into a unit: small files are appended to the open
+    /// shard, large files get a mapping of their own while under the cap.
+    ///
+    /// A mapped file's newline offsets and hash are taken by reading it before
+    /// it is mapped (see `read_chunks`). If the mapping then has a different
+    /// length, the file is being rewritten and is not placed; the event for
+    /// the rewrite loads it once it is done.
+    fn place_file(&mut self, file_idx: usize, file: &mut File, size: u64) -> std::io::Result<Location> {
+        if size <= SHARD_FILE_LIMIT {
+            let unit = self.open_shard_unit();
+            let member = match &mut self.units[unit] {
+                Storage::Shard(shard) => shard.push_file(file_idx, file)?,
+                _ => unreachable!("open shard is not a shard"),
+            };
+            return Ok(Location::Unit { unit, member });
+        }
+
+        let storage = if self.mapped_count < MAX_MAPPED_FILES {
+            let (newlines, hash, len) = scan_file(file)?;
+            let mmap = unsafe { Mmap::map(&*file) }?;
+            if mmap.len() != len {
+                return Err(ErrorKind::InvalidData.into());
+            }
+
+            // Searches scan each file front to back: ask for aggressive
+            // readahead and start faulting the pages in now, so the first
+            // search does not pay for them. Advice is only a hint.
+            let _ = mmap.advise(Advice::Sequential);
+            let _ = mmap.advise(Advice::WillNeed);
+
+            self.mapped_count += 1;
+            Storage::Mapped {
+                file: file_idx,
+                mmap,
+                newlines,
+                hash,
+            }
+        } else {
+            Storage::Cold { file: file_idx }
+        };
+
+        self.units.push(storage);
+        Ok(Location::Unit {
+            unit: self.units.len() - 1,
+            member: 0,
+        })
+    }
+
+    /// Unit number of the open shard, starting a new one if it is full
+    fn open_shard_unit(&mut self) -> usize {
+        match self.open_shard {
+            Some(unit) if matches!(&self.units[unit], Storage::Shard(shard) if !shard.is_full()) => unit,
+            _ => {
+                self.units.push(Storage::Shard(Shard::new()));
+                let unit = self.units.len() - 1;
+                self.open_shard = Some(unit);
+                unit
+            }
+        }
+    }
+
+    /// Number of files held in memory
+    pub fn len(&self) -> usize {
+        self.locations
+            .iter()
+            .filter(|location| matches!(location, Location::Unit { .. }))
+            .count()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.len() == 0
+    }
+
+    /// Version of the cache contents. Every refresh that loads, reloads or
+    /// drops a file moves it to a new value, so results saved alongside an
+    /// epoch are current exactly while the epoch is.
+    pub fn epoch(&self) -> u64 {
+        self.epoch
+    }
+
+    /// Total size of all files held in memory
+    pub fn total_bytes(&self) -> u64 {
+        self.sizes.iter().sum()
+    }
+
+    /// Paths of all files held in memory
+    pub fn paths(&self) -> impl Iterator<Item = &Path> {
+        self.paths
+            .iter()
+            .zip(&self.locations)
+            .filter(|(_, location)| matches!(location, Location::Unit { .. }))
+            .map(|(path, _)| path.as_path())
+    }
+
+    /// Bring the cache up to date after `path` (a file or directory under the
+    /// root) was created, modified or removed. Returns the files whose
+    /// contents in the cache changed.
+    ///
+    /// Known files are reread directly, unless their contents have not
+    /// changed; data appended to a mapped file is taken in without re-reading
+    /// the rest. New paths are found by walking down from the nearest
+    /// directory the cache already knows, so `.gitignore` rules apply to them
+    /// exactly as they did at load time.
+    pub fn refresh(&mut self, path: &Path) -> Vec<FileChange> {
+        if !self.is_stale(path) {
+            return Vec::new();
+        }
+        self.refresh_stale(path)
+    }
+
+    /// `refresh` for a path that `is_stale` has already reported, without
+    /// hashing a known file's contents a second time. If the file went back
+    /// to its old contents in between, it is simply reloaded.
+    pub fn refresh_stale(&mut self, path: &Path) -> Vec<FileChange> {
+        if !self.covers(path) {
+            return Vec::new();
+        }
+        let known = self.by_path.get(path).copied();
+
+        let first_new_unit = self.units.len();
+        let open_before = self.open_shard.map(|unit| (unit, self.unit_len(unit)));
+        let mut indexed = Vec::new();
+        let mut removed = Vec::new();
+
+        if let Some(file_idx) = known {
+            if self.append_mapped(file_idx) {
+                self.epoch = next_epoch();
+                return vec![FileChange::Indexed(self.rel_paths[file_idx].clone())];
+            }
+            let was_loaded = self.remove_file(file_idx);
+            if path.is_file() && self.load_file(path.to_owned()).is_some() {
+                indexed.push(file_idx);
+            } else if was_loaded {
+                removed.push(file_idx);
+            }
+        } else if self.dirs.contains(path) {
+            if !path.is_dir() {
+                removed = self.remove_dir(path);
+            }
+        } else if path.exists() {
+            indexed = self.load_new(path);
+        }
+
+        // Every unit that took new content adds it to the index
+        for unit in first_new_unit..self.units.len() {
+            self.index_unit(unit, 0);
+        }
+        if let Some((unit, len)) = open_before {
+            if self.unit_len(unit) != len {
+                self.index_unit(unit, len);
+            }
+        }
+        if self.dead_bytes > self.total_bytes() {
+            self.drop_dead_units();
+        }
+
+        let indexed = indexed
+            .into_iter()
+            .map(|file_idx| FileChange::Indexed(self.rel_paths[file_idx].clone()));
+        let removed = removed
+            .into_iter()
+            .map(|file_idx| FileChange::Removed(self.rel_paths[file_idx].clone()));
+        let changes: Vec<FileChange> = indexed.chain(removed).collect();
+        // Walks that find nothing loadable leave search results as they were
+        if !changes.is_empty() {
+            self.epoch = next_epoch();
+        }
+        changes
+    }
+
+    /// Whether `refresh` could change anything for `path`. Paths outside the
+    /// root or under a skipped directory, and known files whose contents are
+    /// the same, are ruled out. This takes `&self`, so a batch of paths can be
+    /// checked in parallel under a shared lock, with searches still running,
+    /// before the exclusive lock is taken.
+    ///
+    /// A new path only counts if its parent is a directory the walk entered.
+    /// A new directory is walked whole on its own event, so events from
+    /// inside it add nothing, and paths inside ignored directories (a build
+    /// filling `target/`, say) are dropped here rather than each taking the
+    /// write lock for a walk that loads nothing.
+    pub fn is_stale(&self, path: &Path) -> bool {
+        if !self.covers(path) {
+            return false;
+        }
+        if let Some(&file_idx) = self.by_path.get(path) {
+            return !self.is_unchanged(file_idx);
+        }
+        if self.dirs.contains(path) {
+            return !path.is_dir();
+        }
+        path.parent().is_some_and(|parent| self.dirs.contains(parent))
+    }
+
+    /// Whether `path` is one the cache would load: under the root and outside
+    /// the version control directories the walk skips
+    fn covers(&self, path: &Path) -> bool {
+        let Ok(rel) = path.strip_prefix(&self.root) else {
+            return false;
+        };
+        !rel.components()
+            .any(|part| SKIPPED_DIRECTORIES.iter().any(|dir| part.as_os_str() == *dir))
+    }
+
+    /// Whether a loaded file still holds the contents it was loaded with.
+    /// Editors and watchers often report a file several times for one save
+    /// (a write, then the close), and only the first needs work.
+    ///
+    /// Modification times are no help here: Linux stamps them from a coarse
+    /// clock, so two quick writes of the same size can leave them equal. The
+    /// size is checked first, then the contents: small files against their
+    /// shard bytes, mapped files against the hash taken when they were indexed.
+    fn is_unchanged(&self, file_idx: usize) -> bool {
+        let Location::Unit { unit, member } = self.locations[file_idx] else {
+            return false;
+        };
+        let Ok(mut file) = File::open(&self.paths[file_idx]) else {
+            return false;
+        };
+        let size = self.sizes[file_idx];
+        match file.metadata() {
+            Ok(metadata) if metadata.is_file() && metadata.len() == size => {}
+            _ => return false,
+        }
+
+        match &self.units[unit] {
+            Storage::Shard(shard) => {
+                let mut current = Vec::with_capacity(size as usize);
+                file.read_to_end(&mut current).is_ok()
+                    && shard.member_bytes(member).get(..current.len()) == Some(&current[..])
+                    && current.len() as u64 == size
+            }
+            Storage::Mapped { hash, .. } => {
+                let mut hasher = Xxh3::new();
+                read_chunks(&mut file, |chunk| hasher.update(chunk))
+                    .map_or(false, |read| read == size && hasher.digest() == *hash)
+            }
+            Storage::Cold { .. } | Storage::Dead => false,
+        }
+    }
+
+    /// Take in data appended to a mapped file: remap it, extend the newline
+    /// table and index only the new tail. Returns false, leaving the cache
+    /// untouched, if the file is not mapped or changed other than by growing.
+    fn append_mapped(&mut self, file_idx: usize) -> bool {
+        let Location::Unit { unit, .. } = self.locations[file_idx] else {
+            return false;
+        };
+        let Storage::Mapped {
+            mmap,
+            newlines,
+            hash,
+            ..
+        } = &mut self.units[unit]
+        else {
+            return false;
+        };
+
+        let Ok(file) = File::open(&self.paths[file_idx]) else {
+            return false;
+        };
+        let Ok(metadata) = file.metadata() else {
+            return false;
+        };
+        let old_len = mmap.len();
+        if metadata.len() <= old_len as u64 || metadata.len() > MAX_FILE_BYTES {
+            return false;
+        }
+
+        // Check that the old contents are intact, then hash the tail and find
+        // its newlines, all through reads (see `read_chunks`)
+        let mut hasher = Xxh3::new();
+        match read_chunks((&file).take(old_len as u64), |chunk| hasher.update(chunk)) {
+            Ok(read) if read == old_len as u64 && hasher.digest() == *hash => {}
+            _ => return false,
+        }
+        let mut tail_newlines = Vec::new();
+        let mut end = old_len;
+        let tail = read_chunks(&file, |chunk| {
+            hasher.update(chunk);
+            tail_newlines.extend(memchr_iter(b'\n', chunk).map(|offset| (end + offset) as u32));
+            end += chunk.len();
+        });
+        if tail.is_err() || end == old_len {
+            return false;
+        }
+        let Ok(grown) = (unsafe { Mmap::map(&file) }) else {
+            return false;
+        };
+        if grown.len() != end {
+            return false;
+        }
+
+        let _ = grown.advise(Advice::Sequential);
+        newlines.extend(tail_newlines);
+        *hash = hasher.digest();
+        self.sizes[file_idx] = grown.len() as u64;
+        *mmap = grown;
+
+        // Start two folded characters back for the trigrams that span the old
+        // end. A character folds from up to `MAX_FOLDED_CHAR_BYTES` bytes;
+        // starting inside one only adds a stray trigram or two.
+        self.index_unit(unit, old_len.saturating_sub(2 * trigram::MAX_FOLDED_CHAR_BYTES));
+        true
+    }
+
+    /// Size of a shard's buffer, or 0 for any other unit
+    fn unit_len(&self, unit: usize) -> usize {
+        match &self.units[unit] {
+            Storage::Shard(shard) => shard.buf.len(),
+            _ => 0,
+        }
+    }
+
+    /// Add the trigrams of a unit's bytes from offset `from` on to the index.
+    /// Files are appended to a shard whole, so indexing just the appended
+    /// tail covers them; the only trigrams skipped span two files, and no
+    /// match can.
+    fn index_unit(&mut self, unit: usize, from: usize) {
+        let trigrams = self
+            .with_unit(unit, |unit| trigram::trigrams(&unit.bytes[from..]))
+            .unwrap_or_default();
+        self.index.add(unit as u32, &trigrams);
+    }
+
+    /// Walk down to a path the cache has not seen, from the nearest directory
+    /// it knows, and load whatever the walk accepts at or under that path.
+    /// Returns the file numbers loaded.
+    fn load_new(&mut self, path: &Path) -> Vec<usize> {
+        let Some(start) = path.ancestors().skip(1).find(|dir| self.dirs.contains(*dir)) else {
+            return Vec::new();
+        };
+
+        let target = path.to_owned();
+        let walk = walker(start)
+            .filter_entry(move |entry| {
+                !is_skipped_directory(entry)
+                    && (target.starts_with(entry.path()) || entry.path().starts_with(&target))
+            })
             .build();
 
-        for entry in walker {
-            let entry = entry.context("Failed to read directory entry")?;
+        let mut loaded = Vec::new();
+        for entry in walk.flatten() {
+            let known = self
+                .by_path
+                .get(entry.path())
+                .map_or(false, |&file_idx| matches!(self.locations[file_idx], Location::Unit { .. }));
+            if !known {
+                loaded.extend(self.add_entry(entry));
+            }
+        }
+
+        loaded
+    }
+
+    /// Drop a file's current contents. Returns whether it was loaded.
+    fn remove_file(&mut self, file_idx: usize) -> bool {
+        let Location::Unit { unit, member } = self.locations[file_idx] else {
+            return false;
+        };
+        self.locations[file_idx] = Location::Absent;
+        let size = std::mem::take(&mut self.sizes[file_idx]);
 
-            if !entry.file_type().map(|ft| ft.is_file()).unwrap_or(false) {
+        match &mut self.units[unit] {
+            Storage::Shard(shard) => {
+                shard.remove_member(member);
+                if shard.is_mostly_removed() && self.open_shard != Some(unit) {
+                    self.compact_shard(unit);
+                }
+            }
+            Storage::Mapped { .. } => {
+                self.mapped_count -= 1;
+                self.units[unit] = Storage::Dead;
+                self.dead_bytes += size;
+            }
+            Storage::Cold { .. } => {
+                self.units[unit] = Storage::Dead;
+                self.dead_bytes += size;
+            }
+            Storage::Dead => {}
+        }
+
+        true
+    }
+
+    /// Move the live members of a shard into the open shard and retire it
+    fn compact_shard(&mut self, unit: usize) {
+        let Storage::Shard(shard) = std::mem::replace(&mut self.units[unit], Storage::Dead) else {
+            return;
+        };
+        self.dead_bytes += shard.buf.len() as u64;
+
+        for member in 0..shard.files.len() {
+            if shard.removed[member] {
                 continue;
             }
+            let file_idx = shard.files[member];
+            let open = self.open_shard_unit();
+            if let Storage::Shard(open_shard) = &mut self.units[open] {
+                let new_member = open_shard.push_bytes(file_idx, shard.member_bytes(member));
+                self.locations[file_idx] = Location::Unit {
+                    unit: open,
+                    member: new_member,
+                };
+            }
+        }
+    }
 
-            let path = entry.path();
+    /// Remove dead units, renumber the rest and rebuild the index without the
+    /// dead units' trigrams. This costs as much as indexing the live files
+    /// again, so it only runs once dead content outweighs live content, and
+    /// is paid for by at least that many bytes of changes.
+    fn drop_dead_units(&mut self) {
+        let mut renumbered = Vec::with_capacity(self.units.len());
+        let mut next = 0;
+        for storage in &self.units {
+            renumbered.push(next);
+            if !matches!(storage, Storage::Dead) {
+                next += 1;
+            }
+        }
 
-            // Skip binary files
-            if let Some(ext) = path.extension() {
-                let ext_str = ext.to_string_lossy();
-                if matches!(
-                    ext_str.as_ref(),
-                    "png" | "jpg" | "jpeg" | "gif" | "pdf" | "zip" | "tar" | "gz" |
-                    "so" | "dylib" | "dll" | "exe" | "bin" | "o" | "a"
-                ) {
-                    continue;
-                }
+        self.units.retain(|storage| !matches!(storage, Storage::Dead));
+        for location in &mut self.locations {
+            if let Location::Unit { unit, .. } = location {
+                *unit = renumbered[*unit];
             }
+        }
+        self.open_shard = self.open_shard.map(|unit| renumbered[unit]);
+        self.index = self.build_index();
+        self.dead_bytes = 0;
+    }
 
-            match File::open(path) {
-                Ok(file) => {
-                    let metadata = file.metadata()?;
-                    let file_size = metadata.len();
+    /// Drop every file and directory at or under a removed directory.
+    /// Returns the file numbers that were loaded.
+    fn remove_dir(&mut self, dir: &Path) -> Vec<usize> {
+        self.dirs.retain(|known| !known.starts_with(dir));
 
-                    // Skip very large files (>50MB) and empty files
-                    if file_size > 50 * 1024 * 1024 || file_size == 0 {
-                        continue;
-                    }
+        let doomed: Vec<usize> = self
+            .by_path
+            .iter()
+            .filter(|(path, _)| path.starts_with(dir))
+            .map(|(_, &file_idx)| file_idx)
+            .collect();
 
-                    match unsafe { Mmap::map(&file) } {
-                        Ok(mmap) => {
-                            file_count += 1;
-                            total_bytes += file_size;
-                            files.insert(path.to_owned(), mmap);
-                        }
-                        Err(_) => continue,
-                    }
+        doomed
+            .into_iter()
+            .filter(|&file_idx| self.remove_file(file_idx))
+            .collect()
+    }
+
+    /// Run `f` on unit `i`. A large file past the mapping cap is mapped just
+    /// for the call. Returns `None` for a dead unit, or if that file can no
+    /// longer be mapped.
+    fn with_unit<R>(&self, i: usize, f: impl FnOnce(Unit<'_>) -> R) -> Option<R> {
+        match &self.units[i] {
+            Storage::Mapped {
+                file,
+                mmap,
+                newlines,
+                ..
+            } => Some(f(Unit::single(file, mmap, newlines))),
+            Storage::Shard(shard) => Some(f(shard.unit())),
+            Storage::Cold { file } => {
+                let mapped = File::open(&self.paths[*file]).ok()?;
+                let mmap = unsafe { Mmap::map(&mapped) }.ok()?;
+                if mmap.len() as u64 > MAX_FILE_BYTES {
+                    return None;
                 }
-                Err(_) => continue,
+                let _ = mmap.advise(Advice::Sequential);
+                let newlines = newline_offsets(&mmap);
+
+                Some(f(Unit::single(file, &mmap, &newlines)))
             }
+            Storage::Dead => None,
         }
+    }
 
-        println!(
-            "Loaded {} files ({:.2} MB total) into memory",
-            file_count,
-            total_bytes as f64 / 1024.0 / 1024.0
-        );
+    /// Extract every unit's trigrams in parallel and build the index from them
+    fn build_index(&self) -> TrigramIndex {
+        let unit_trigrams: Vec<Vec<u32>> = (0..self.units.len())
+            .into_par_iter()
+            .map(|i| {
+                self.with_unit(i, |unit| trigram::trigrams(unit.bytes))
+                    .unwrap_or_default()
+            })
+            .collect();
 
-        Ok(Self {
-            files,
-            root: root.to_owned(),
-        })
+        let mut index = TrigramIndex::new();
+        for (i, trigrams) in unit_trigrams.iter().enumerate() {
+            index.add(i as u32, trigrams);
+        }
+
+        index
     }
 
-    /// Search all memory-mapped files for the given pattern
-    pub fn search(&self, pattern: &str, case_sensitive: bool) -> Result<Vec<(String, u64, String)>> {
-        let matcher = RegexMatcherBuilder::new()
-            .case_insensitive(!case_sensitive)
-            .build(pattern)
-            .context("Invalid regex pattern")?;
-
-        // Search all files in parallel
-        let all_matches: Vec<Vec<(String, u64, String)>> = self
-            .files
-            .par_iter()
-            .map(|(path, mmap)| {
-                let mut matches = Vec::new();
-                let mut searcher = Searcher::new();
-
-                let rel_path = path
-                    .strip_prefix(&self.root)
-                    .unwrap_or(path)
-                    .to_string_lossy()
-                    .to_string();
-
-                let _ = searcher.search_slice(
-                    &matcher,
-                    &mmap[..],
-                    UTF8(|line_num, line| {
-                        matches.push((rel_path.clone(), line_num, line.trim_end().to_string()));
-                        Ok(true)
-                    }),
-                );
-
-                matches
+    /// Search all memory-mapped files for the given pattern. Callers that
+    /// repeat patterns should compile through a `QueryCache` and use
+    /// `search_with` instead.
+    pub fn search(&self, pattern: &str, case_sensitive: bool) -> Result<Vec<(&str, u64, String)>> {
+        self.search_with(&Query::new(pattern, case_sensitive)?)
+    }
+
+    /// Search all memory-mapped files with an already compiled query
+    pub fn search_with(&self, query: &Query) -> Result<Vec<(&str, u64, String)>> {
+        // Per-unit results are flattened straight into the output instead of
+        // being collected as a Vec per unit
+        let matches = self
+            .scan_units(query, |searcher, unit| {
+                let bytes = unit.bytes;
+                let mut sink = UnitSink {
+                    unit,
+                    rel_paths: &self.rel_paths,
+                    matches: Vec::new(),
+                };
+                sink.search_query(searcher, query, bytes);
+                sink.matches
             })
+            .flatten_iter()
             .collect();
 
-        Ok(all_matches.into_iter().flatten().collect())
+        Ok(matches)
+    }
+
+    /// Count the lines matching an already compiled query, without building
+    /// the matched lines themselves
+    pub fn count_with(&self, query: &Query) -> Result<u64> {
+        let count = self
+            .scan_units(query, |searcher, unit| {
+                let bytes = unit.bytes;
+                let mut sink = CountSink { unit, count: 0 };
+                sink.search_query(searcher, query, bytes);
+                sink.count
+            })
+            .sum();
+
+        Ok(count)
+    }
+
+    /// Run `scan` on each unit that can match `query`, in parallel. Each
+    /// rayon worker reuses one Searcher for every unit it picks up. Dead
+    /// units, and cold files that can no longer be mapped, give
+    /// `R::default()`.
+    fn scan_units<'s, R: Default + Send + 's>(
+        &'s self,
+        query: &Query,
+        scan: impl Fn(&mut Searcher, Unit<'_>) -> R + Sync + Send + 's,
+    ) -> impl ParallelIterator<Item = R> + 's {
+        self.candidate_units(query).into_par_iter().map_init(
+            // Line numbers come from the cached newline offsets, so the
+            // searcher does not need to count lines itself
+            || SearcherBuilder::new().line_number(false).build(),
+            move |searcher, i| {
+                self.with_unit(i, |unit| scan(searcher, unit))
+                    .unwrap_or_default()
+            },
+        )
+    }
+
+    /// Units that can contain a match: units holding every trigram of the
+    /// pattern's literals, or all units if it has none
+    fn candidate_units(&self, query: &Query) -> Vec<usize> {
+        match self.index.candidates(&query.literals) {
+            Some(units) => units.into_iter().map(|unit| unit as usize).collect(),
+            None => (0..self.units.len()).collect(),
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::fs;
+    use std::io::{Seek, Write};
+
+    /// A fresh, empty directory for one test
+    fn temp_root(name: &str) -> PathBuf {
+        let root = std::env::temp_dir().join(format!("curserve-{}-{}", name, std::process::id()));
+        let _ = fs::remove_dir_all(&root);
+        fs::create_dir_all(&root).unwrap();
+        root
+    }
+
+    /// Sorted matches of a case-insensitive search, with owned paths so
+    /// results from two caches can be compared
+    fn search(cache: &MmapCache, pattern: &str) -> Vec<(String, u64, String)> {
+        let query = Query::new(pattern, false).unwrap();
+        let mut matches: Vec<_> = cache
+            .search_with(&query)
+            .unwrap()
+            .into_iter()
+            .map(|(path, line, text)| (path.to_string(), line, text))
+            .collect();
+        matches.sort();
+        matches
+    }
+
+    /// Check a refreshed cache against one loaded from scratch
+    fn assert_same_as_fresh(cache: &MmapCache, pattern: &str) {
+        let fresh = MmapCache::new(&cache.root).unwrap();
+        assert_eq!(search(cache, pattern), search(&fresh, pattern), "pattern {:?}", pattern);
+        let query = Query::new(pattern, false).unwrap();
+        assert_eq!(cache.count_with(&query).unwrap(), fresh.count_with(&query).unwrap());
+    }
+
+    fn matches(results: &[(&str, u64, &str)]) -> Vec<(String, u64, String)> {
+        results
+            .iter()
+            .map(|&(path, line, text)| (path.to_string(), line, text.to_string()))
+            .collect()
+    }
+
+    #[test]
+    fn removed_shard_members_match_regex_path() {
+        let root = temp_root("removed-members");
+        fs::write(root.join("a.txt"), "hello\nnothing\n").unwrap();
+        fs::write(root.join("b.txt"), "say HELLO").unwrap();
+        fs::write(root.join("c.txt"), "hello again\nand \u{17F}o hello").unwrap();
+
+        let mut cache = MmapCache::new(&root).unwrap();
+        fs::remove_file(root.join("b.txt")).unwrap();
+        cache.refresh(&root.join("b.txt"));
+        fs::write(root.join("c.txt"), "rewritten, hello").unwrap();
+        cache.refresh(&root.join("c.txt"));
+
+        // "hell[o]" has regex syntax, so it takes the regex path
+        let literal = Query::new("hello", false).unwrap();
+        let regex = Query::new("hell[o]", false).unwrap();
+        assert!(literal.ascii_literal.is_some() && regex.ascii_literal.is_none());
+
+        let mut by_literal = cache.search_with(&literal).unwrap();
+        let mut by_regex = cache.search_with(&regex).unwrap();
+        by_literal.sort();
+        by_regex.sort();
+        assert_eq!(by_literal, by_regex);
+        assert_eq!(
+            by_literal,
+            vec![
+                ("a.txt", 1, "hello".to_string()),
+                ("c.txt", 1, "rewritten, hello".to_string()),
+            ]
+        );
+        assert_eq!(cache.count_with(&literal).unwrap(), 2);
+        assert_eq!(cache.count_with(&regex).unwrap(), 2);
+
+        fs::remove_dir_all(&root).unwrap();
+    }
+
+    #[test]
+    fn rewrites_do_not_grow_the_index() {
+        let root = temp_root("rewrites");
+        let big = root.join("big.txt");
+        let filler = "filler line\n".repeat(8 * 1024);
+        fs::write(root.join("small.txt"), "small needle\n").unwrap();
+
+        let mut cache = MmapCache::new(&root).unwrap();
+        for round in 0..20 {
+            fs::write(&big, format!("{}needle {}\n", filler, round)).unwrap();
+            cache.refresh(&big);
+            assert!(cache.units.len() <= 4, "{} units after {} rewrites", cache.units.len(), round);
+        }
+
+        let query = Query::new("needle", false).unwrap();
+        let mut matches = cache.search_with(&query).unwrap();
+        matches.sort();
+        assert_eq!(
+            matches,
+            vec![
+                ("big.txt", 8 * 1024 + 1, "needle 19".to_string()),
+                ("small.txt", 1, "small needle".to_string()),
+            ]
+        );
+
+        fs::remove_dir_all(&root).unwrap();
+    }
+
+    #[test]
+    fn mapped_file_appends_rewrites_and_shrinks() {
+        let root = temp_root("mapped");
+        let big = root.join("big.txt");
+        let filler = "filler line\n".repeat(8 * 1024);
+        fs::write(&big, format!("{}needle one\n", filler)).unwrap();
+        let mut cache = MmapCache::new(&root).unwrap();
+        assert!(matches!(cache.units[0], Storage::Mapped { .. }));
+
+        // Appends are taken into the same unit, including a line split
+        // across two appends
+        let units = cache.units.len();
+        let append = |bytes: &[u8]| {
+            let mut file = fs::OpenOptions::new().append(true).open(&big).unwrap();
+            file.write_all(bytes).unwrap();
+        };
+        append(b"needle two\nlast nee");
+        cache.refresh(&big);
+        append(b"dle here");
+        cache.refresh(&big);
+        assert_eq!(cache.units.len(), units);
+        assert_eq!(
+            search(&cache, "needle"),
+            matches(&[
+                ("big.txt", 8193, "needle one"),
+                ("big.txt", 8194, "needle two"),
+                ("big.txt", 8195, "last needle here"),
+            ])
+        );
+        assert_same_as_fresh(&cache, "needle");
+        assert_same_as_fresh(&cache, "filler");
+
+        // Rewritten in place at the same size
+        let mut file = fs::OpenOptions::new().write(true).open(&big).unwrap();
+        file.seek(std::io::SeekFrom::Start(8 * 1024 * 12)).unwrap();
+        file.write_all(b"NEEDLE ONE").unwrap();
+        drop(file);
+        cache.refresh(&big);
+        assert_eq!(search(&cache, "needle one"), matches(&[("big.txt", 8193, "NEEDLE ONE")]));
+        assert_same_as_fresh(&cache, "needle");
+
+        // Shrunk, and still large enough to be mapped
+        fs::write(&big, format!("needle first\n{}", &filler[..filler.len() / 2])).unwrap();
+        cache.refresh(&big);
+        assert_eq!(search(&cache, "needle"), matches(&[("big.txt", 1, "needle first")]));
+        assert_same_as_fresh(&cache, "filler");
+
+        // Deleted, then created again
+        fs::remove_file(&big).unwrap();
+        assert_eq!(cache.refresh(&big), vec![FileChange::Removed("big.txt".to_string())]);
+        assert!(search(&cache, "needle").is_empty());
+        fs::write(&big, format!("{}{}back needle\n", filler, filler)).unwrap();
+        assert_eq!(cache.refresh(&big), vec![FileChange::Indexed("big.txt".to_string())]);
+        assert_eq!(search(&cache, "needle"), matches(&[("big.txt", 16385, "back needle")]));
+        assert_same_as_fresh(&cache, "filler");
+
+        fs::remove_dir_all(&root).unwrap();
+    }
+
+    #[test]
+    fn removed_directories_and_compacted_shards() {
+        let root = temp_root("shards");
+        fs::create_dir_all(root.join("sub/deep")).unwrap();
+        fs::write(root.join("sub/a.txt"), "needle in sub\n").unwrap();
+        fs::write(root.join("sub/deep/b.txt"), "deep\nneedle in deep\n").unwrap();
+
+        // Enough small files to close the first shard, so it can be compacted
+        let body = "x".repeat(60_000);
+        let files = SHARD_TARGET_BYTES / 60_000 + 20;
+        for i in 0..files {
+            let contents = format!("needle {}\n{}\ntail {}\n", i, body, i);
+            fs::write(root.join(format!("f{}.txt", i)), contents).unwrap();
+        }
+        let mut cache = MmapCache::new(&root).unwrap();
+        assert_same_as_fresh(&cache, "needle");
+
+        fs::remove_dir_all(root.join("sub")).unwrap();
+        let mut removed = cache.refresh(&root.join("sub"));
+        removed.sort_by(|a, b| format!("{:?}", a).cmp(&format!("{:?}", b)));
+        assert_eq!(
+            removed,
+            vec![
+                FileChange::Removed("sub/a.txt".to_string()),
+                FileChange::Removed("sub/deep/b.txt".to_string()),
+            ]
+        );
+        assert!(cache.refresh(&root.join("sub/deep/b.txt")).is_empty());
+
+        // Removing all but a few files leaves the closed shard mostly removed;
+        // it is compacted into the open one, and the dead shard dropped
+        for i in 3..files {
+            let path = root.join(format!("f{}.txt", i));
+            fs::remove_file(&path).unwrap();
+            cache.refresh(&path);
+        }
+        assert_eq!(cache.units.len(), 1);
+        assert_eq!(
+            search(&cache, "tail"),
+            matches(&[("f0.txt", 3, "tail 0"), ("f1.txt", 3, "tail 1"), ("f2.txt", 3, "tail 2")])
+        );
+        assert_same_as_fresh(&cache, "needle");
+
+        fs::remove_dir_all(&root).unwrap();
     }
 }
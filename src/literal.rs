@@ -0,0 +1,159 @@
+//! Fast path for case-insensitive searches for a plain ASCII literal.
+//!
+//! Such patterns are the most common agent query (`use`, `fn`, `struct`), and
+//! a direct scan beats running the general regex engine over every unit:
+//! memchr finds each place the first character could start, and the rest of
+//! the needle is compared with ASCII case folding.
+//!
+//! The scan keeps the regex engine's Unicode semantics. Two non-ASCII
+//! characters case-fold to ASCII letters, U+017F LATIN SMALL LETTER LONG S
+//! (`s`) and U+212A KELVIN SIGN (`k`), and both are matched where the needle
+//! has that letter.
+
+use memchr::memchr3;
+
+/// UTF-8 encoding of U+017F LATIN SMALL LETTER LONG S
+const LONG_S: &[u8] = "\u{17F}".as_bytes();
+
+/// UTF-8 encoding of U+212A KELVIN SIGN
+const KELVIN: &[u8] = "\u{212A}".as_bytes();
+
+/// The lowercased needle for `pattern`, if it is a case-insensitive search
+/// for a non-empty ASCII string with no regex syntax in it
+pub fn folded_ascii_literal(pattern: &str, case_sensitive: bool) -> Option<Vec<u8>> {
+    if case_sensitive
+        || pattern.is_empty()
+        || !pattern.is_ascii()
+        || pattern.chars().any(regex_syntax::is_meta_character)
+    {
+        return None;
+    }
+
+    Some(pattern.to_ascii_lowercase().into_bytes())
+}
+
+/// Whether `haystack[at..]` starts with `needle` under case folding
+fn folded_eq(haystack: &[u8], mut at: usize, needle: &[u8]) -> bool {
+    for &n in needle {
+        let rest = &haystack[at.min(haystack.len())..];
+        match rest.first() {
+            Some(&b) if b.to_ascii_lowercase() == n => at += 1,
+            _ if n == b's' && rest.starts_with(LONG_S) => at += LONG_S.len(),
+            _ if n == b'k' && rest.starts_with(KELVIN) => at += KELVIN.len(),
+            _ => return false,
+        }
+    }
+
+    true
+}
+
+/// Call `f` with the offset of each match of the folded `needle` in
+/// `haystack`. `f` returns the offset to resume scanning from, which lets the
+/// caller skip the rest of a line it has already reported.
+pub fn for_each_match(haystack: &[u8], needle: &[u8], mut f: impl FnMut(usize) -> usize) {
+    let first = needle[0];
+    let upper = first.to_ascii_uppercase();
+    // Lead byte of the non-ASCII character that also folds to `first`, if any
+    let lead = match first {
+        b's' => LONG_S[0],
+        b'k' => KELVIN[0],
+        _ => upper,
+    };
+
+    let mut pos = 0;
+    while pos < haystack.len() {
+        let Some(found) = memchr3(first, upper, lead, &haystack[pos..]) else {
+            break;
+        };
+        let at = pos + found;
+
+        pos = if folded_eq(haystack, at, needle) {
+            f(at).max(at + 1)
+        } else {
+            at + 1
+        };
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use memchr::memchr;
+    use regex::bytes::RegexBuilder;
+
+    /// Start offsets of the lines `for_each_match` reports, skipping the
+    /// rest of a line once it matched, as the search sinks do
+    fn literal_lines(haystack: &[u8], pattern: &str) -> Vec<usize> {
+        let needle = folded_ascii_literal(pattern, false).unwrap();
+        let mut lines = Vec::new();
+        for_each_match(haystack, &needle, |at| {
+            let start = haystack[..at]
+                .iter()
+                .rposition(|&b| b == b'\n')
+                .map_or(0, |nl| nl + 1);
+            lines.push(start);
+            memchr(b'\n', &haystack[at..]).map_or(haystack.len(), |nl| at + nl + 1)
+        });
+        lines
+    }
+
+    /// Start offsets of the lines the case-insensitive regex matches
+    fn regex_lines(haystack: &[u8], pattern: &str) -> Vec<usize> {
+        let re = RegexBuilder::new(&regex::escape(pattern))
+            .case_insensitive(true)
+            .build()
+            .unwrap();
+        let mut lines = Vec::new();
+        let mut start = 0;
+        for line in haystack.split(|&b| b == b'\n') {
+            if re.is_match(line) {
+                lines.push(start);
+            }
+            start += line.len() + 1;
+        }
+        lines
+    }
+
+    fn assert_same_lines(haystack: &str, pattern: &str) {
+        assert_eq!(
+            literal_lines(haystack.as_bytes(), pattern),
+            regex_lines(haystack.as_bytes(), pattern),
+            "pattern {:?} in {:?}",
+            pattern,
+            haystack
+        );
+    }
+
+    #[test]
+    fn matches_regex_at_line_edges() {
+        let haystack = "use std;\nfoo use\nno match\nUSE at start\nends with use\nlast use";
+        assert_same_lines(haystack, "use");
+        assert_same_lines(haystack, "USE");
+        assert_same_lines("last line without newline: fn", "fn");
+        assert_same_lines("fn\n", "fn");
+        assert_same_lines("\n\nfn\n\n", "fn");
+        assert_same_lines("fnfnfn twice on one line\nfn", "fn");
+        assert_same_lines("partial f", "fn");
+        assert_same_lines("", "fn");
+    }
+
+    #[test]
+    fn matches_regex_on_special_folds() {
+        let haystack = "\u{17F}truct\nu\u{17F}e\n\u{212A}elvin\nla\u{212A}e\n\u{150}ther\nstruct";
+        for pattern in ["struct", "use", "kelvin", "lake", "se", "k", "s"] {
+            assert_same_lines(haystack, pattern);
+        }
+        // U+0150 shares the long s lead byte, and must not match
+        assert_same_lines("\u{150}truct\n", "struct");
+    }
+
+    #[test]
+    fn only_plain_case_insensitive_literals_qualify() {
+        assert_eq!(folded_ascii_literal("Use", false), Some(b"use".to_vec()));
+        assert_eq!(folded_ascii_literal("use", true), None);
+        assert_eq!(folded_ascii_literal("fn \\w+", false), None);
+        assert_eq!(folded_ascii_literal("a.b", false), None);
+        assert_eq!(folded_ascii_literal("", false), None);
+        assert_eq!(folded_ascii_literal("caf\u{e9}", false), None);
+    }
+}
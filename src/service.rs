@@ -1,16 +1,90 @@
-use anyhow::{Context, Result};
-use crossbeam_channel::{bounded, Receiver, Sender};
-use curserve::MmapCache;
+use anyhow::{bail, Context, Result};
+use crossbeam_channel::{unbounded, Receiver, RecvTimeoutError, Sender};
+use curserve::{FileChange, MmapCache, Query, QueryCache, QUERY_CACHE_CAPACITY};
+use log::{debug, error, info, warn, Level};
+use notify::event::{AccessKind, AccessMode, ModifyKind};
+use notify::{Config, Event, EventKind, PollWatcher, RecommendedWatcher, RecursiveMode, Watcher};
+use rayon::prelude::*;
 use serde::{Deserialize, Serialize};
-use std::collections::HashMap;
+use std::collections::{HashMap, HashSet, VecDeque};
+use std::fmt::Write as _;
 use std::fs;
-use std::io::{BufRead, BufReader, Write};
+use std::io::{BufReader, ErrorKind, Read, Write};
+use std::os::unix::io::AsRawFd;
 use std::os::unix::net::{UnixListener, UnixStream};
-use std::path::Path;
-use std::sync::{Arc, Mutex};
+use std::path::{Path, PathBuf};
+use std::sync::{Arc, Mutex, RwLock};
 use std::thread;
+use std::time::{Duration, Instant};
 
-const REQUEST_SOCKET: &str = "/tmp/mem_search_service_requests.sock";
+/// Rule printed around section headers
+const SEP: &str = "================================================================================";
+
+/// Name of the shared request socket. On Linux this lives in the abstract
+/// namespace; elsewhere it is a socket file under /tmp.
+const REQUEST_SOCKET: &str = "mem_search_service_requests";
+
+/// Upper bound on a single frame, guards against a corrupt length prefix
+const MAX_FRAME_LEN: usize = 256 * 1024 * 1024;
+
+/// Send buffer size for client streams. The default Unix socket buffer is small
+/// enough that a large ripgrep result is pushed out in many partial writes.
+const SEND_BUFFER_BYTES: libc::c_int = 1 << 20;
+
+/// Receive buffer size for request streams, so a burst of pipelined requests
+/// can be drained without the client blocking on a full socket
+const RECV_BUFFER_BYTES: libc::c_int = 1 << 20;
+
+/// Capacity of the buffered reader on each request stream. A frame's length
+/// prefix and a typical request payload arrive in one read syscall.
+const READ_BUFFER_BYTES: usize = 64 * 1024;
+
+/// Largest response buffer a connection keeps for reuse between responses
+const MAX_RETAINED_FRAME_BYTES: usize = 4 * 1024 * 1024;
+
+/// How often roots on network file systems are rescanned for changes
+const POLL_INTERVAL: Duration = Duration::from_secs(1);
+
+/// How long the watcher gathers events for a path before reloading it
+const DEBOUNCE: Duration = Duration::from_millis(20);
+
+/// How often an idle event stream checks whether its client has hung up
+const HANGUP_CHECK_INTERVAL: Duration = Duration::from_secs(1);
+
+/// Number of search results kept for repeated searches
+const RESULT_CACHE_CAPACITY: usize = 64;
+
+/// Largest encoded result kept for repeated searches. Bigger results are
+/// rare, and caching them would pin a lot of memory.
+const MAX_CACHED_RESULT_BYTES: usize = 1024 * 1024;
+
+/// Environment variable that turns on per-request logging when set to 1
+const VERBOSE_VAR: &str = "CURSERVE_VERBOSE";
+
+/// Environment variable that makes roots on FUSE file systems polled rather
+/// than watched when set to 1
+const POLL_FUSE_VAR: &str = "CURSERVE_POLL_FUSE";
+
+/// Start logging. Service events are logged at info and per-request and
+/// per-file messages at debug, which is only enabled with `CURSERVE_VERBOSE=1`:
+/// every line costs a write syscall, which under load is more than the search
+/// itself, while a disabled `debug!` is one level comparison. `RUST_LOG`
+/// overrides both.
+fn init_logging() {
+    let verbose = std::env::var(VERBOSE_VAR).map_or(false, |value| value == "1");
+    let default_filter = if verbose {
+        "info,mem_search_service=debug"
+    } else {
+        "info"
+    };
+
+    env_logger::Builder::from_env(env_logger::Env::default().default_filter_or(default_filter))
+        .format(|buf, record| match record.level() {
+            Level::Error | Level::Warn => writeln!(buf, "{}: {}", record.level(), record.args()),
+            _ => writeln!(buf, "{}", record.args()),
+        })
+        .init();
+}
 
 /// Request types from clients
 #[derive(Debug, Deserialize)]
@@ -27,17 +101,81 @@ enum Request {
         pattern: String,
         #[serde(default)]
         case_sensitive: bool,
+        /// Only compile the pattern into the query cache, without searching
+        #[serde(default)]
+        precompile: bool,
+        /// Return matches in the binary layout of `encode_matches` rather
+        /// than as ripgrep-formatted JSON text
+        #[serde(default)]
+        binary: bool,
     },
+    /// Only the number of matching lines, without sending the lines themselves
+    #[serde(rename = "request_ripgrep_count")]
+    RequestRipgrepCount {
+        pid: u32,
+        pattern: String,
+        #[serde(default)]
+        case_sensitive: bool,
+    },
+    /// Several searches in one round trip, answered with one text per pattern
+    #[serde(rename = "request_ripgrep_many")]
+    RequestRipgrepMany {
+        pid: u32,
+        patterns: Vec<String>,
+        #[serde(default)]
+        case_sensitive: bool,
+    },
+    /// Turn the connection into a stream of file events for the PID's codebase
+    #[serde(rename = "subscribe_events")]
+    SubscribeEvents { pid: u32 },
+    /// Free the PID's codebase, so the watcher lets go of its root before the
+    /// client deletes it
+    #[serde(rename = "dealloc_pid")]
+    DeallocPid { pid: u32 },
+    /// Current epoch of the PID's codebase, which moves whenever the watcher
+    /// applies a change, so a client can skip searches that cannot differ
+    #[serde(rename = "index_epoch")]
+    IndexEpoch { pid: u32 },
+}
+
+/// A request plus the optional id the client tagged it with. Responses come
+/// back on the same connection, in order, and echo the id, so a client can
+/// match them up without a second socket.
+#[derive(Debug, Deserialize)]
+struct Envelope {
+    #[serde(default)]
+    req_id: Option<u64>,
+    #[serde(flatten)]
+    request: Request,
 }
 
 /// Response types sent back to clients
-#[derive(Debug, Serialize)]
+#[derive(Debug, Default, Serialize)]
 struct Response {
+    #[serde(skip_serializing_if = "Option::is_none")]
+    req_id: Option<u64>,
     response_status: u8, // 1 = success, 0 = failure
     #[serde(skip_serializing_if = "Option::is_none")]
     text: Option<String>,
+    /// Result of a request_ripgrep_count
+    #[serde(skip_serializing_if = "Option::is_none")]
+    count: Option<u64>,
+    /// Results of a request_ripgrep_many, one per pattern
+    #[serde(skip_serializing_if = "Option::is_none")]
+    texts: Option<Vec<String>>,
+    /// Result of an index_epoch
+    #[serde(skip_serializing_if = "Option::is_none")]
+    epoch: Option<u64>,
     #[serde(skip_serializing_if = "Option::is_none")]
     error: Option<String>,
+    /// Pre-encoded binary payload, sent instead of the JSON fields
+    #[serde(skip)]
+    binary: Option<Vec<u8>>,
+    /// Pre-encoded JSON of a text result, without `req_id`, sent instead of
+    /// the JSON fields. Shared with the result cache, so a cached result is
+    /// neither copied nor escaped again.
+    #[serde(skip)]
+    json: Option<Arc<[u8]>>,
 }
 
 impl Response {
@@ -45,185 +183,1007 @@ impl Response {
         Self {
             response_status: 1,
             text,
-            error: None,
+            ..Self::default()
+        }
+    }
+
+    fn success_count(count: u64) -> Self {
+        Self {
+            response_status: 1,
+            count: Some(count),
+            ..Self::default()
+        }
+    }
+
+    fn success_epoch(epoch: u64) -> Self {
+        Self {
+            response_status: 1,
+            epoch: Some(epoch),
+            ..Self::default()
+        }
+    }
+
+    fn success_many(texts: Vec<String>) -> Self {
+        Self {
+            response_status: 1,
+            texts: Some(texts),
+            ..Self::default()
+        }
+    }
+
+    fn binary(payload: Vec<u8>) -> Self {
+        Self {
+            response_status: 1,
+            binary: Some(payload),
+            ..Self::default()
+        }
+    }
+
+    /// A text result, encoded once so it can be kept in the result cache
+    fn encoded_text(text: String) -> Result<Self> {
+        let json = serde_json::to_vec(&Self::success(Some(text)))?;
+        Ok(Self::encoded(json.into()))
+    }
+
+    fn encoded(json: Arc<[u8]>) -> Self {
+        Self {
+            response_status: 1,
+            json: Some(json),
+            ..Self::default()
         }
     }
 
     fn failure(error: String) -> Self {
         Self {
             response_status: 0,
-            text: None,
             error: Some(error),
+            ..Self::default()
+        }
+    }
+}
+
+/// File event pushed to subscribed clients once the watcher has applied it
+#[derive(Debug, Clone, Serialize)]
+#[serde(tag = "type", rename_all = "snake_case")]
+enum WatchEvent {
+    /// A file was loaded or reloaded, and searches now see its new contents
+    Indexed { path: String },
+    /// A file was dropped from the codebase
+    Removed { path: String },
+    /// The watcher lost events and the whole codebase was reloaded, so any
+    /// file may have changed
+    Rescanned,
+}
+
+impl From<FileChange> for WatchEvent {
+    fn from(change: FileChange) -> Self {
+        match change {
+            FileChange::Indexed(path) => WatchEvent::Indexed { path },
+            FileChange::Removed(path) => WatchEvent::Removed { path },
         }
     }
 }
 
-/// Shared state between threads
+/// Key of a cached search result: codebase root, pattern, case sensitivity
+type ResultKey = (PathBuf, String, bool);
+
+/// Least-recently-used cache of search results, as encoded responses. Each
+/// result is stored with the epoch of the codebase it was read from and is
+/// only returned while the codebase is still at that epoch, so any change the
+/// watcher applies invalidates it.
+struct ResultCache {
+    entries: HashMap<ResultKey, (u64, Arc<[u8]>, u64)>,
+    capacity: usize,
+    clock: u64,
+}
+
+impl ResultCache {
+    fn new(capacity: usize) -> Self {
+        Self {
+            entries: HashMap::new(),
+            capacity: capacity.max(1),
+            clock: 0,
+        }
+    }
+
+    /// The result saved for `key` at `epoch`, if there is one
+    fn get(&mut self, key: &ResultKey, epoch: u64) -> Option<Arc<[u8]>> {
+        self.clock += 1;
+        match self.entries.get_mut(key) {
+            Some((saved_epoch, json, last_used)) if *saved_epoch == epoch => {
+                *last_used = self.clock;
+                Some(Arc::clone(json))
+            }
+            _ => None,
+        }
+    }
+
+    /// Save a result, replacing any older one for the same key
+    fn insert(&mut self, key: ResultKey, epoch: u64, json: Arc<[u8]>) {
+        if json.len() > MAX_CACHED_RESULT_BYTES {
+            return;
+        }
+        if self.entries.len() >= self.capacity && !self.entries.contains_key(&key) {
+            // Evict the least recently used result
+            if let Some(oldest) = self
+                .entries
+                .iter()
+                .min_by_key(|(_, (_, _, last_used))| *last_used)
+                .map(|(key, _)| key.clone())
+            {
+                self.entries.remove(&oldest);
+            }
+        }
+
+        self.entries.insert(key, (epoch, json, self.clock));
+    }
+}
+
+/// Which watcher a root is registered with
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+enum WatchKind {
+    /// The platform's native watcher (inotify, FSEvents, ...)
+    Native,
+    /// The polling watcher, for roots on network file systems
+    Poll,
+}
+
+/// A codebase loaded from one root, shared by every PID that allocated it
+struct SharedCodebase {
+    cache: Arc<RwLock<MmapCache>>,
+    /// Number of PIDs using this codebase
+    users: usize,
+    /// Watcher the root was registered with, or `None` if it is not watched.
+    /// Recorded rather than worked out again at unwatch time, when the root
+    /// may already be deleted or unmounted.
+    watch: Option<WatchKind>,
+}
+
+/// Roots that lost their last user, with the watcher each was registered
+/// with, to be unwatched once the state lock is released
+type Unloaded = Vec<(PathBuf, WatchKind)>;
+
+/// File system watchers. Registering a recursive watch walks the whole tree
+/// (and the polling watcher scans it), so the watchers have a lock of their
+/// own and are never used while the state lock is held.
+struct Watchers {
+    /// Native watcher, if one could be started
+    native: Option<RecommendedWatcher>,
+    /// Polling watcher for roots on network file systems
+    poller: Option<PollWatcher>,
+}
+
+impl Watchers {
+    /// The watcher of the given kind, if it could be started
+    fn get(&mut self, kind: WatchKind) -> Option<&mut dyn Watcher> {
+        match kind {
+            WatchKind::Native => self.native.as_mut().map(|w| w as &mut dyn Watcher),
+            WatchKind::Poll => self.poller.as_mut().map(|w| w as &mut dyn Watcher),
+        }
+    }
+
+    /// Start watching a codebase root with one recursive watch. inotify only
+    /// sees changes made through the local kernel, so edits on another client
+    /// of a network file system never produce events; such roots are polled
+    /// instead. Returns the watcher used, or `None` if no watch was set up.
+    fn watch(&mut self, root: &Path) -> Option<WatchKind> {
+        let kind = if is_network_filesystem(root) {
+            WatchKind::Poll
+        } else {
+            WatchKind::Native
+        };
+        match self.get(kind)?.watch(root, RecursiveMode::Recursive) {
+            Ok(()) => Some(kind),
+            Err(e) => {
+                warn!("Failed to watch {}: {}", root.display(), e);
+                None
+            }
+        }
+    }
+
+    /// Stop watching a codebase root with the watcher it was registered with
+    fn unwatch(&mut self, root: &Path, kind: WatchKind) {
+        if let Some(watcher) = self.get(kind) {
+            let _ = watcher.unwatch(root);
+        }
+    }
+}
+
+/// Shared state between threads.
+///
+/// The state lock is only held for map lookups and updates. It is never held
+/// while taking a codebase lock: a watcher waiting for a write lock blocks new
+/// readers, so doing so could stall every request behind one long search.
 struct ServiceState {
-    /// Mapping from PID to memory-mapped codebase
-    codebases: HashMap<u32, MmapCache>,
-    /// Mapping from PID to response socket stream
-    response_sockets: HashMap<u32, UnixStream>,
-    /// Mapping from PID to response socket listener (for accepting connections)
-    response_listeners: HashMap<u32, UnixListener>,
+    /// Root of the codebase allocated to each PID. The codebase itself is in
+    /// `roots`; each has its own lock, so searches run in parallel and only
+    /// wait on watcher updates to the codebase they read.
+    codebases: HashMap<u32, PathBuf>,
+    /// Loaded codebases by canonical root. Agents working in the same
+    /// repository share one copy, loaded and watched once.
+    roots: HashMap<PathBuf, SharedCodebase>,
+    /// Roots being loaded, so concurrent allocations of one root load it once
+    loading: HashMap<PathBuf, Arc<Mutex<()>>>,
+    /// Connections subscribed to each root's file events, by subscription id
+    subscribers: HashMap<PathBuf, Vec<(u64, Sender<WatchEvent>)>>,
+    /// Id of the next subscription
+    next_subscription: u64,
+    /// Compiled patterns, shared by every PID so a pattern is compiled once
+    /// per service lifetime rather than once per codebase. Behind its own
+    /// lock, and patterns are compiled without holding it (see
+    /// `compile_query`), so a slow compile never stalls other clients.
+    queries: Arc<Mutex<QueryCache>>,
+    /// Results of recent searches. Behind its own lock, so it can be used
+    /// while a codebase is locked without taking the state lock.
+    results: Arc<Mutex<ResultCache>>,
+    /// File system watchers. Always locked before the state lock, never while
+    /// holding it.
+    watchers: Arc<Mutex<Watchers>>,
 }
 
 impl ServiceState {
-    fn new() -> Self {
+    fn new(watchers: Watchers) -> Self {
         Self {
             codebases: HashMap::new(),
-            response_sockets: HashMap::new(),
-            response_listeners: HashMap::new(),
+            roots: HashMap::new(),
+            loading: HashMap::new(),
+            subscribers: HashMap::new(),
+            next_subscription: 0,
+            queries: Arc::new(Mutex::new(QueryCache::new(QUERY_CACHE_CAPACITY))),
+            results: Arc::new(Mutex::new(ResultCache::new(RESULT_CACHE_CAPACITY))),
+            watchers: Arc::new(Mutex::new(watchers)),
+        }
+    }
+
+    /// The codebase allocated to a PID
+    fn codebase(&self, pid: u32) -> Option<Arc<RwLock<MmapCache>>> {
+        self.shared_codebase(self.codebases.get(&pid)?)
+    }
+
+    /// Whether the PID's codebase is kept up to date by a watcher. Without
+    /// one its epoch never moves, so it says nothing about whether the
+    /// files changed.
+    fn is_watched(&self, pid: u32) -> bool {
+        self.codebases
+            .get(&pid)
+            .and_then(|root| self.roots.get(root))
+            .is_some_and(|shared| shared.watch.is_some())
+    }
+
+    /// The codebase already loaded from a root, if any
+    fn shared_codebase(&self, root: &Path) -> Option<Arc<RwLock<MmapCache>>> {
+        self.roots.get(root).map(|shared| Arc::clone(&shared.cache))
+    }
+
+    /// Allocate the codebase for `root` to a PID, releasing any codebase it
+    /// had before. If the root is already loaded, that copy is used and
+    /// `cache` is dropped. Returns the codebase in use. A newly loaded root
+    /// is not watched yet; see `watch_root`.
+    fn attach_codebase(
+        &mut self,
+        pid: u32,
+        root: &Path,
+        cache: Arc<RwLock<MmapCache>>,
+        unloaded: &mut Unloaded,
+    ) -> Arc<RwLock<MmapCache>> {
+        let shared = self.roots.entry(root.to_owned()).or_insert(SharedCodebase {
+            cache,
+            users: 0,
+            watch: None,
+        });
+        shared.users += 1;
+        let cache = Arc::clone(&shared.cache);
+
+        // Released after attaching, so reallocating the same root keeps it loaded
+        self.remove_codebase(pid, unloaded);
+        self.codebases.insert(pid, root.to_owned());
+
+        cache
+    }
+
+    /// Free a PID's codebase. The last user of a root unloads it, and adds it
+    /// to `unloaded` if it was watched. Returns false if the PID had no
+    /// codebase.
+    fn remove_codebase(&mut self, pid: u32, unloaded: &mut Unloaded) -> bool {
+        let Some(root) = self.codebases.remove(&pid) else {
+            return false;
+        };
+        let Some(shared) = self.roots.get_mut(&root) else {
+            return true;
+        };
+        shared.users -= 1;
+        if shared.users == 0 {
+            let watch = shared.watch;
+            self.roots.remove(&root);
+            // Ends the subscribers' event streams
+            self.subscribers.remove(&root);
+            if let Some(kind) = watch {
+                unloaded.push((root, kind));
+            }
+        }
+
+        true
+    }
+
+    /// Send events to every connection subscribed to a root, dropping
+    /// connections that have gone away
+    fn publish(&mut self, root: &Path, events: &[WatchEvent]) {
+        let Some(subscribers) = self.subscribers.get_mut(root) else {
+            return;
+        };
+        subscribers.retain(|(_, tx)| events.iter().all(|event| tx.send(event.clone()).is_ok()));
+    }
+
+    /// Subscribe to a root's file events. Returns the subscription id, for
+    /// `unsubscribe`, and the receiving end.
+    fn subscribe(&mut self, root: PathBuf) -> (u64, Receiver<WatchEvent>) {
+        let id = self.next_subscription;
+        self.next_subscription += 1;
+        let (event_tx, event_rx) = unbounded();
+        self.subscribers.entry(root).or_default().push((id, event_tx));
+        (id, event_rx)
+    }
+
+    fn unsubscribe(&mut self, root: &Path, id: u64) {
+        if let Some(subscribers) = self.subscribers.get_mut(root) {
+            subscribers.retain(|&(other, _)| other != id);
         }
     }
 }
 
+/// Watch a root that was just loaded, and record which watcher has it. Runs
+/// without the state lock. If the root was freed while the watch was being
+/// set up, the watch is removed again.
+fn watch_root(state: &Mutex<ServiceState>, root: &Path, cache: &Arc<RwLock<MmapCache>>) {
+    let watchers = Arc::clone(&state.lock().unwrap().watchers);
+    let mut watchers = watchers.lock().unwrap();
+    let watch = watchers.watch(root);
+
+    let mut state = state.lock().unwrap();
+    match state.roots.get_mut(root) {
+        Some(shared) if Arc::ptr_eq(&shared.cache, cache) => shared.watch = watch,
+        // Loaded again by another allocation, which sets up its own watch
+        Some(_) => {}
+        None => {
+            drop(state);
+            if let Some(kind) = watch {
+                watchers.unwatch(root, kind);
+            }
+        }
+    }
+}
+
+/// Stop watching roots that lost their last user, unless they have been
+/// loaded again since. Runs without the state lock.
+///
+/// Loaded roots can be nested. inotify gives an inode a single watch, and a
+/// recursive unwatch drops every watch under the root, so the inner tree's
+/// watches are shared by both roots. A root inside another watched root is
+/// left registered, as the outer watch still covers it; roots inside an
+/// unwatched root are registered again.
+fn unwatch_roots(state: &Mutex<ServiceState>, unloaded: Unloaded) {
+    if unloaded.is_empty() {
+        return;
+    }
+    let watchers = Arc::clone(&state.lock().unwrap().watchers);
+    let mut watchers = watchers.lock().unwrap();
+    for (root, kind) in unloaded {
+        let nested: Vec<PathBuf> = {
+            let state = state.lock().unwrap();
+            if state.roots.contains_key(&root) {
+                continue;
+            }
+            state
+                .roots
+                .iter()
+                .filter(|(other, shared)| {
+                    shared.watch == Some(kind) && (other.starts_with(&root) || root.starts_with(other))
+                })
+                .map(|(other, _)| other.clone())
+                .collect()
+        };
+        if nested.iter().any(|other| root.starts_with(other)) {
+            continue;
+        }
+
+        watchers.unwatch(&root, kind);
+        for other in nested {
+            let watched = watchers
+                .get(kind)
+                .is_some_and(|watcher| watcher.watch(&other, RecursiveMode::Recursive).is_ok());
+            if !watched {
+                warn!("Failed to watch {} again", other.display());
+                if let Some(shared) = state.lock().unwrap().roots.get_mut(&other) {
+                    shared.watch = None;
+                }
+            }
+        }
+    }
+}
+
+/// Free a PID's codebase, and stop watching its root if no other PID uses
+/// it. Returns false if the PID had no codebase.
+fn free_codebase(state: &Mutex<ServiceState>, pid: u32) -> bool {
+    let mut unloaded = Vec::new();
+    let freed = state.lock().unwrap().remove_codebase(pid, &mut unloaded);
+    unwatch_roots(state, unloaded);
+    freed
+}
+
+/// Whether `path` is on a network file system (NFS, SMB/CIFS, 9P, ...)
+#[cfg(target_os = "linux")]
+fn is_network_filesystem(path: &Path) -> bool {
+    use std::os::unix::ffi::OsStrExt;
+
+    // Superblock magic numbers, from linux/magic.h
+    const NETWORK_MAGIC: &[u32] = &[
+        0x6969,     // NFS
+        0x517B,     // SMB
+        0xFF534D42, // CIFS
+        0xFE534D42, // SMB2
+        0x01021997, // 9P (VM and WSL shares)
+        0x00C36400, // Ceph
+        0x5346414F, // AFS
+        0x73757245, // Coda
+    ];
+    // Most FUSE file systems are local (fuse-overlayfs in rootless
+    // containers, gocryptfs, ntfs-3g) and inotify sees their writes, while
+    // polling stats the whole tree every second. Network ones such as sshfs
+    // are only polled on request.
+    const FUSE_MAGIC: u32 = 0x65735546;
+
+    let Ok(path) = std::ffi::CString::new(path.as_os_str().as_bytes()) else {
+        return false;
+    };
+    let mut stat: libc::statfs = unsafe { std::mem::zeroed() };
+    if unsafe { libc::statfs(path.as_ptr(), &mut stat) } != 0 {
+        return false;
+    }
+
+    let magic = stat.f_type as u32;
+    NETWORK_MAGIC.contains(&magic)
+        || (magic == FUSE_MAGIC && std::env::var(POLL_FUSE_VAR).map_or(false, |value| value == "1"))
+}
+
+/// Whether `path` is on a network file system (NFS, SMB, AFP, ...)
+#[cfg(target_os = "macos")]
+fn is_network_filesystem(path: &Path) -> bool {
+    use std::os::unix::ffi::OsStrExt;
+
+    let Ok(path) = std::ffi::CString::new(path.as_os_str().as_bytes()) else {
+        return false;
+    };
+    let mut stat: libc::statfs = unsafe { std::mem::zeroed() };
+    if unsafe { libc::statfs(path.as_ptr(), &mut stat) } != 0 {
+        return false;
+    }
+
+    stat.f_flags & libc::MNT_LOCAL as u32 == 0
+}
+
+#[cfg(not(any(target_os = "linux", target_os = "macos")))]
+fn is_network_filesystem(_path: &Path) -> bool {
+    false
+}
+
+/// Bind a listening socket by name. On Linux the name goes in the abstract
+/// namespace, so there is no file to create, chmod or unlink, and the name is
+/// released automatically when the service exits.
+#[cfg(target_os = "linux")]
+fn bind_socket(name: &str) -> Result<UnixListener> {
+    use std::os::linux::net::SocketAddrExt;
+    use std::os::unix::net::SocketAddr;
+
+    let addr = SocketAddr::from_abstract_name(name.as_bytes())?;
+    UnixListener::bind_addr(&addr).with_context(|| format!("Failed to bind socket @{}", name))
+}
+
+/// Bind a listening socket by name, as a socket file under /tmp
+#[cfg(not(target_os = "linux"))]
+fn bind_socket(name: &str) -> Result<UnixListener> {
+    let path = socket_label(name);
+
+    // Remove old socket if it exists
+    let _ = fs::remove_file(&path);
+
+    UnixListener::bind(&path).with_context(|| format!("Failed to bind socket {}", path))
+}
+
+/// Human-readable address of a named socket, as clients should connect to it
+fn socket_label(name: &str) -> String {
+    if cfg!(target_os = "linux") {
+        format!("@{}", name)
+    } else {
+        format!("/tmp/{}.sock", name)
+    }
+}
+
+/// Remove a named socket's file, if the platform needed one
+fn unlink_socket(name: &str) {
+    if !cfg!(target_os = "linux") {
+        let _ = fs::remove_file(socket_label(name));
+    }
+}
+
 /// Handle alloc_pid request
 fn handle_alloc_pid(
-    state: &mut ServiceState,
+    state: &Mutex<ServiceState>,
     pid: u32,
     repo_dir_path: String,
 ) -> Result<Response> {
-    let repo_path = Path::new(&repo_dir_path);
+    // Watch events carry absolute paths, so the root is stored in the same form
+    let repo_path = match fs::canonicalize(&repo_dir_path) {
+        Ok(path) => path,
+        Err(_) => {
+            return Ok(Response::failure(format!(
+                "Repository path does not exist: {}",
+                repo_dir_path
+            )))
+        }
+    };
+
+    info!("[PID {}] Allocating codebase: {}", pid, repo_dir_path);
+
+    // Allocations of the same root queue up behind a single load
+    let load_lock = Arc::clone(
+        state
+            .lock()
+            .unwrap()
+            .loading
+            .entry(repo_path.clone())
+            .or_default(),
+    );
+    let _loading = load_lock.lock().unwrap();
+
+    // Reuse the copy another PID already loaded from this root. Otherwise
+    // create the MmapCache; loading is the slow part, so it happens without
+    // holding the state lock.
+    let shared = state.lock().unwrap().shared_codebase(&repo_path);
+    let loaded = shared.is_none();
+    let cache = match shared {
+        Some(cache) => cache,
+        None => match MmapCache::new(&repo_path) {
+            Ok(cache) => Arc::new(RwLock::new(cache)),
+            Err(e) => {
+                state.lock().unwrap().loading.remove(&repo_path);
+                return Ok(Response::failure(format!(
+                    "Failed to load codebase: {}",
+                    e
+                )));
+            }
+        },
+    };
 
-    if !repo_path.exists() {
+    let mut unloaded = Vec::new();
+    let cache = {
+        let mut state = state.lock().unwrap();
+        state.loading.remove(&repo_path);
+        state.attach_codebase(pid, &repo_path, cache, &mut unloaded)
+    };
+    unwatch_roots(state, unloaded);
+    if loaded {
+        watch_root(state, &repo_path, &cache);
+    }
+    let files = cache.read().unwrap().len();
+
+    Ok(Response::success(Some(format!("Allocated {} files", files))))
+}
+
+/// Handle dealloc_pid request
+fn handle_dealloc_pid(state: &Mutex<ServiceState>, pid: u32) -> Result<Response> {
+    if !free_codebase(state, pid) {
         return Ok(Response::failure(format!(
-            "Repository path does not exist: {}",
-            repo_dir_path
+            "PID {} has no allocated codebase",
+            pid
         )));
     }
 
-    println!("[PID {}] Allocating codebase: {}", pid, repo_dir_path);
+    info!("[PID {}] Freed codebase", pid);
 
-    // Create the MmapCache for this codebase
-    match MmapCache::new(repo_path) {
-        Ok(cache) => {
-            state.codebases.insert(pid, cache);
+    Ok(Response::success(None))
+}
 
-            // Create response socket listener
-            let response_socket_path = format!("/tmp/qwen_code_response_{}.sock", pid);
+/// Format matches like ripgrep (`path:line_num:content`, one per line).
+/// Everything is appended to one pre-sized buffer instead of allocating a
+/// String per line and joining them afterwards.
+fn format_matches(matches: &[(&str, u64, String)]) -> String {
+    // path + ':' + line number (20 digits max) + ':' + content + '\n'
+    let capacity = matches
+        .iter()
+        .map(|(path, _, content)| path.len() + content.len() + 23)
+        .sum();
+    let mut output = String::with_capacity(capacity);
 
-            // Remove old socket if it exists
-            let _ = fs::remove_file(&response_socket_path);
+    for (i, (path, line_num, content)) in matches.iter().enumerate() {
+        if i > 0 {
+            output.push('\n');
+        }
+        output.push_str(path);
+        output.push(':');
+        let _ = write!(output, "{}", line_num);
+        output.push(':');
+        output.push_str(content);
+    }
 
-            // Create the socket listener (but don't wait for connections here)
-            let listener = UnixListener::bind(&response_socket_path)
-                .context("Failed to bind response socket")?;
+    output
+}
 
-            state.response_listeners.insert(pid, listener);
+/// First byte of a binary response. JSON responses always start with `{`, so
+/// a client can tell the two apart from the first payload byte.
+const BINARY_RESPONSE_TAG: u8 = 0;
 
-            println!("[PID {}] Response socket created at {}", pid, response_socket_path);
+/// Append `value` as an unsigned LEB128 varint
+fn push_varint(out: &mut Vec<u8>, mut value: u64) {
+    while value >= 0x80 {
+        out.push(value as u8 | 0x80);
+        value >>= 7;
+    }
+    out.push(value as u8);
+}
 
-            // Return success immediately - client will connect to response socket after receiving this response
-            Ok(Response::success(Some(format!(
-                "Allocated {} files",
-                state.codebases.get(&pid).unwrap().files.len()
-            ))))
-        }
-        Err(e) => Ok(Response::failure(format!(
-            "Failed to load codebase: {}",
-            e
-        ))),
+/// Encode matches in the binary response layout:
+///
+/// ```text
+/// u8 tag (0)
+/// u64 req_id (0 if the request had none)
+/// u32 n_files, then per file:   u16 path_len, path bytes
+/// u32 n_matches, then per match: varint file_id, varint line_num,
+///                                varint content_len, content bytes
+/// ```
+///
+/// Fixed-width integers are big-endian, like the frame length. Each path is
+/// sent once, and content is sent raw, so source code needs no JSON escaping.
+fn encode_matches(req_id: Option<u64>, matches: &[(&str, u64, String)]) -> Result<Vec<u8>> {
+    let mut file_ids: HashMap<&str, u64> = HashMap::new();
+    let mut files = Vec::new();
+    let mut body = Vec::with_capacity(
+        matches
+            .iter()
+            .map(|(_, _, content)| content.len() + 8)
+            .sum(),
+    );
+
+    for (path, line_num, content) in matches {
+        let file_id = *file_ids.entry(path).or_insert_with(|| {
+            files.push(*path);
+            files.len() as u64 - 1
+        });
+        push_varint(&mut body, file_id);
+        push_varint(&mut body, *line_num);
+        push_varint(&mut body, content.len() as u64);
+        body.extend_from_slice(content.as_bytes());
     }
+
+    let table_len: usize = files.iter().map(|path| path.len() + 2).sum();
+    let mut out = Vec::with_capacity(1 + 8 + 4 + table_len + 4 + body.len());
+    out.push(BINARY_RESPONSE_TAG);
+    out.extend_from_slice(&req_id.unwrap_or(0).to_be_bytes());
+    out.extend_from_slice(&u32::try_from(files.len()).context("Too many files")?.to_be_bytes());
+    for path in files {
+        let len = u16::try_from(path.len()).with_context(|| format!("Path too long: {}", path))?;
+        out.extend_from_slice(&len.to_be_bytes());
+        out.extend_from_slice(path.as_bytes());
+    }
+    out.extend_from_slice(&u32::try_from(matches.len()).context("Too many matches")?.to_be_bytes());
+    out.extend_from_slice(&body);
+
+    Ok(out)
+}
+
+/// The compiled query for a pattern, from the shared cache. A new pattern is
+/// compiled with no lock held; two clients compiling the same new pattern at
+/// once both do the work, and the first to finish is kept.
+fn compile_query(
+    queries: &Mutex<QueryCache>,
+    pattern: &str,
+    case_sensitive: bool,
+) -> Result<Arc<Query>> {
+    if let Some(query) = queries.lock().unwrap().lookup(pattern, case_sensitive) {
+        return Ok(query);
+    }
+
+    let query = Arc::new(Query::new(pattern, case_sensitive)?);
+    Ok(queries.lock().unwrap().insert(pattern, case_sensitive, query))
+}
+
+/// Failure response for a PID with no codebase
+fn no_codebase(pid: u32) -> Response {
+    Response::failure(format!("PID {} has no allocated codebase. Call alloc_pid first.", pid))
+}
+
+/// The codebase allocated to a PID, or the failure response to send if it
+/// has none
+fn allocated_codebase(
+    state: &Mutex<ServiceState>,
+    pid: u32,
+) -> Result<Arc<RwLock<MmapCache>>, Response> {
+    state.lock().unwrap().codebase(pid).ok_or_else(|| no_codebase(pid))
 }
 
 /// Handle request_ripgrep request
 fn handle_ripgrep(
-    state: &ServiceState,
+    state: &Mutex<ServiceState>,
+    req_id: Option<u64>,
     pid: u32,
     pattern: String,
     case_sensitive: bool,
+    precompile: bool,
+    binary: bool,
 ) -> Result<Response> {
-    // Check if PID has an allocated codebase
-    let cache = match state.codebases.get(&pid) {
-        Some(c) => c,
-        None => {
-            return Ok(Response::failure(format!(
-                "PID {} has no allocated codebase. Call alloc_pid first.",
-                pid
-            )))
-        }
+    let (queries, results) = {
+        let state = state.lock().unwrap();
+        // Results of an unwatched codebase cannot be told apart from stale ones
+        let results = state.is_watched(pid).then(|| Arc::clone(&state.results));
+        (Arc::clone(&state.queries), results)
+    };
+    let query = match compile_query(&queries, &pattern, case_sensitive) {
+        Ok(query) => query,
+        Err(e) => return Ok(Response::failure(format!("Search failed: {}", e))),
+    };
+
+    if precompile {
+        return Ok(Response::success(Some(format!("Precompiled pattern: {}", pattern))));
+    }
+
+    let cache = match allocated_codebase(state, pid) {
+        Ok(cache) => cache,
+        Err(response) => return Ok(response),
     };
 
-    println!("[PID {}] Searching for pattern: {}", pid, pattern);
+    debug!("[PID {}] Searching for pattern: {}", pid, pattern);
+
+    let cache = cache.read().unwrap();
+    let key = (cache.root.clone(), pattern, case_sensitive);
+    let results = results.filter(|_| !binary);
+    if let Some(results) = &results {
+        // Agents poll with the same search until a change shows up; between
+        // watcher updates the answer cannot differ
+        if let Some(json) = results.lock().unwrap().get(&key, cache.epoch()) {
+            debug!("[PID {}] Reusing cached result", pid);
+            return Ok(Response::encoded(json));
+        }
+    }
 
     // Perform the search
-    match cache.search(&pattern, case_sensitive) {
+    match cache.search_with(&query) {
         Ok(matches) => {
-            // Format output like ripgrep: path:line_num:content
-            let output = matches
-                .iter()
-                .map(|(path, line_num, content)| format!("{}:{}:{}", path, line_num, content))
-                .collect::<Vec<_>>()
-                .join("\n");
-
-            println!("[PID {}] Found {} matches", pid, matches.len());
-            Ok(Response::success(Some(output)))
+            debug!("[PID {}] Found {} matches", pid, matches.len());
+            if binary {
+                match encode_matches(req_id, &matches) {
+                    Ok(payload) => Ok(Response::binary(payload)),
+                    Err(e) => Ok(Response::failure(format!("Failed to encode matches: {}", e))),
+                }
+            } else {
+                let text = format_matches(&matches);
+                let Some(results) = &results else {
+                    return Ok(Response::success(Some(text)));
+                };
+                let response = Response::encoded_text(text)?;
+                if let Some(json) = &response.json {
+                    results.lock().unwrap().insert(key, cache.epoch(), Arc::clone(json));
+                }
+                Ok(response)
+            }
         }
         Err(e) => Ok(Response::failure(format!("Search failed: {}", e))),
     }
 }
 
-/// Send response to client's response socket
-fn send_response(state: &mut ServiceState, pid: u32, response: &Response) -> Result<()> {
-    let socket = state.response_sockets.get_mut(&pid).context(format!(
-        "No response socket for PID {}",
-        pid
-    ))?;
+/// Handle index_epoch request
+fn handle_index_epoch(state: &Mutex<ServiceState>, pid: u32) -> Result<Response> {
+    let cache = match allocated_codebase(state, pid) {
+        Ok(cache) => cache,
+        Err(response) => return Ok(response),
+    };
+
+    let epoch = cache.read().unwrap().epoch();
+    Ok(Response::success_epoch(epoch))
+}
 
-    let json = serde_json::to_string(response)?;
-    socket.write_all(json.as_bytes())?;
-    socket.write_all(b"\n")?; // Newline delimiter
-    socket.flush()?;
+/// Handle request_ripgrep_count request
+fn handle_ripgrep_count(
+    state: &Mutex<ServiceState>,
+    pid: u32,
+    pattern: &str,
+    case_sensitive: bool,
+) -> Result<Response> {
+    let queries = Arc::clone(&state.lock().unwrap().queries);
+    let query = match compile_query(&queries, pattern, case_sensitive) {
+        Ok(query) => query,
+        Err(e) => return Ok(Response::failure(format!("Search failed: {}", e))),
+    };
+
+    let cache = match allocated_codebase(state, pid) {
+        Ok(cache) => cache,
+        Err(response) => return Ok(response),
+    };
+
+    debug!("[PID {}] Counting matches for pattern: {}", pid, pattern);
+
+    let cache = cache.read().unwrap();
+    match cache.count_with(&query) {
+        Ok(count) => Ok(Response::success_count(count)),
+        Err(e) => Ok(Response::failure(format!("Search failed: {}", e))),
+    }
+}
+
+/// Handle request_ripgrep_many request: run every search and answer with one
+/// formatted result per pattern, in order
+fn handle_ripgrep_many(
+    state: &Mutex<ServiceState>,
+    pid: u32,
+    patterns: &[String],
+    case_sensitive: bool,
+) -> Result<Response> {
+    let cache_queries = Arc::clone(&state.lock().unwrap().queries);
+
+    let mut queries = Vec::with_capacity(patterns.len());
+    for pattern in patterns {
+        match compile_query(&cache_queries, pattern, case_sensitive) {
+            Ok(query) => queries.push(query),
+            Err(e) => {
+                return Ok(Response::failure(format!(
+                    "Search failed for pattern {:?}: {}",
+                    pattern, e
+                )))
+            }
+        }
+    }
+
+    let cache = match allocated_codebase(state, pid) {
+        Ok(cache) => cache,
+        Err(response) => return Ok(response),
+    };
+
+    debug!("[PID {}] Searching for {} patterns", pid, patterns.len());
+
+    let cache = cache.read().unwrap();
+    let mut texts = Vec::with_capacity(queries.len());
+    for query in &queries {
+        match cache.search_with(query) {
+            Ok(matches) => texts.push(format_matches(&matches)),
+            Err(e) => return Ok(Response::failure(format!("Search failed: {}", e))),
+        }
+    }
+
+    Ok(Response::success_many(texts))
+}
+
+/// Read one length-prefixed frame: a 4-byte big-endian length followed by the payload.
+/// The payload is read into `payload`, which is reused across frames so a
+/// connection does not allocate a fresh buffer per request.
+/// Returns `false` if the peer closed the connection cleanly before the next frame.
+fn read_frame(stream: &mut impl Read, payload: &mut Vec<u8>) -> Result<bool> {
+    let mut len_buf = [0u8; 4];
+    match stream.read_exact(&mut len_buf) {
+        Ok(()) => {}
+        Err(e) if e.kind() == ErrorKind::UnexpectedEof => return Ok(false),
+        Err(e) => return Err(e.into()),
+    }
+
+    let len = u32::from_be_bytes(len_buf) as usize;
+    if len > MAX_FRAME_LEN {
+        bail!("Frame of {} bytes exceeds limit of {} bytes", len, MAX_FRAME_LEN);
+    }
+
+    payload.clear();
+    payload.resize(len, 0);
+    stream.read_exact(payload)?;
+    Ok(true)
+}
+
+/// Serialize a message as JSON straight into a complete frame (length prefix
+/// + payload) in `frame`, so it goes out in a single write instead of one per
+/// part. `frame` is cleared first; reusing it across a connection's messages
+/// means it grows to the largest one once instead of allocating every time.
+fn encode_frame(message: &impl Serialize, frame: &mut Vec<u8>) -> Result<()> {
+    frame.clear();
+    frame.extend_from_slice(&[0u8; 4]);
+    serde_json::to_writer(&mut *frame, message)?;
+    finish_frame(frame)
+}
+
+/// Fill in the length prefix of a frame whose payload follows 4 placeholder bytes
+fn finish_frame(frame: &mut [u8]) -> Result<()> {
+    let len = u32::try_from(frame.len() - 4).context("Frame too large")?;
+    frame[..4].copy_from_slice(&len.to_be_bytes());
 
     Ok(())
 }
 
-/// Send response directly on a given stream (used for alloc_pid responses)
-fn send_response_on_stream(stream: &mut UnixStream, response: &Response) -> Result<()> {
-    let json = serde_json::to_string(response)?;
-    stream.write_all(json.as_bytes())?;
-    stream.write_all(b"\n")?; // Newline delimiter
-    stream.flush()?;
+/// Serialize a response into `frame` (length prefix + JSON, or a pre-encoded payload)
+fn encode_response(response: &Response, frame: &mut Vec<u8>) -> Result<()> {
+    if let Some(payload) = &response.binary {
+        frame.clear();
+        frame.extend_from_slice(&[0u8; 4]);
+        frame.extend_from_slice(payload);
+        return finish_frame(frame);
+    }
+    let Some(json) = &response.json else {
+        return encode_frame(response, frame);
+    };
+
+    // The pre-encoded object has no `req_id`; put it first, where serde
+    // would have
+    frame.clear();
+    frame.extend_from_slice(&[0u8; 4]);
+    match response.req_id {
+        Some(req_id) => {
+            write!(frame, "{{\"req_id\":{},", req_id)?;
+            frame.extend_from_slice(&json[1..]);
+        }
+        None => frame.extend_from_slice(json),
+    }
+    finish_frame(frame)
+}
+
+/// Write one frame from the connection's reusable buffer. A buffer left
+/// much larger than usual by one huge response is released afterwards.
+fn write_frame(stream: &mut impl Write, frame: &mut Vec<u8>) -> Result<()> {
+    let written = stream.write_all(frame);
+    if frame.capacity() > MAX_RETAINED_FRAME_BYTES {
+        *frame = Vec::new();
+    }
+
+    Ok(written?)
+}
+
+/// Write one response frame
+fn write_response(stream: &mut impl Write, response: &Response, frame: &mut Vec<u8>) -> Result<()> {
+    encode_response(response, frame)?;
+    write_frame(stream, frame)
+}
+
+/// Set a socket buffer size option (`SO_SNDBUF` / `SO_RCVBUF`) on a stream
+fn set_socket_buffer(stream: &UnixStream, option: libc::c_int, bytes: libc::c_int) -> Result<()> {
+    let ret = unsafe {
+        libc::setsockopt(
+            stream.as_raw_fd(),
+            libc::SOL_SOCKET,
+            option,
+            &bytes as *const libc::c_int as *const libc::c_void,
+            std::mem::size_of::<libc::c_int>() as libc::socklen_t,
+        )
+    };
+    if ret != 0 {
+        return Err(std::io::Error::last_os_error()).context("setsockopt failed");
+    }
 
     Ok(())
 }
 
-/// Handle a single client connection - can handle multiple requests
-fn handle_client_connection(mut stream: UnixStream, request_tx: Sender<(Request, UnixStream)>) {
-    loop {
-        // Create a new reader for each request to avoid borrowing issues
-        let mut reader = BufReader::new(&mut stream);
-        let mut line = String::new();
+/// Handle a single client connection - can handle multiple requests.
+///
+/// Requests are answered on the connection's own thread, one at a time and in
+/// order, so different clients are served in parallel while each connection
+/// still gets its responses in the order it sent the requests.
+fn handle_client_connection(stream: UnixStream, state: Arc<Mutex<ServiceState>>) {
+    let mut reader = BufReader::with_capacity(READ_BUFFER_BYTES, &stream);
+    let mut frame = Vec::new();
+    let mut out = Vec::new();
 
-        match reader.read_line(&mut line) {
-            Ok(0) => {
+    loop {
+        match read_frame(&mut reader, &mut frame) {
+            Ok(false) => {
                 // Connection closed by client
                 break;
             }
-            Ok(_) => {
-                match serde_json::from_str::<Request>(line.trim()) {
+            Ok(true) => {
+                match serde_json::from_slice::<Envelope>(&frame) {
                     Ok(request) => {
-                        println!("Received request: {:?}", request);
-                        // Clone the stream for the worker to use
-                        if let Ok(stream_clone) = stream.try_clone() {
-                            if let Err(e) = request_tx.send((request, stream_clone)) {
-                                eprintln!("Failed to send request to worker: {}", e);
-                                break;
-                            }
-                        } else {
-                            eprintln!("Failed to clone stream");
+                        debug!("Received request: {:?}", request);
+                        if !handle_request(&state, request, &stream, &mut out) {
                             break;
                         }
                     }
                     Err(e) => {
-                        eprintln!("Failed to parse request: {}", e);
+                        warn!("Failed to parse request: {}", e);
                         break;
                     }
                 }
             }
             Err(e) => {
-                eprintln!("Error reading from client: {}", e);
+                error!("Error reading from client: {}", e);
                 break;
             }
         }
@@ -231,26 +1191,30 @@ fn handle_client_connection(mut stream: UnixStream, request_tx: Sender<(Request,
 }
 
 /// Request listener thread - accepts connections and spawns handlers
-fn request_listener(request_tx: Sender<(Request, UnixStream)>) -> Result<()> {
-    // Remove old socket if it exists
-    let _ = fs::remove_file(REQUEST_SOCKET);
-
-    let listener =
-        UnixListener::bind(REQUEST_SOCKET).context("Failed to bind request socket")?;
+fn request_listener(state: Arc<Mutex<ServiceState>>) -> Result<()> {
+    let listener = bind_socket(REQUEST_SOCKET)?;
 
-    println!("Request listener started on {}", REQUEST_SOCKET);
+    info!("Request listener started on {}", socket_label(REQUEST_SOCKET));
 
     for stream in listener.incoming() {
         match stream {
             Ok(stream) => {
+                // Responses are written back on this stream
+                if let Err(e) = set_socket_buffer(&stream, libc::SO_SNDBUF, SEND_BUFFER_BYTES) {
+                    warn!("Failed to enlarge send buffer: {}", e);
+                }
+                if let Err(e) = set_socket_buffer(&stream, libc::SO_RCVBUF, RECV_BUFFER_BYTES) {
+                    warn!("Failed to enlarge receive buffer: {}", e);
+                }
+
                 // Spawn a thread to handle this client connection
-                let tx = request_tx.clone();
+                let state = Arc::clone(&state);
                 thread::spawn(move || {
-                    handle_client_connection(stream, tx);
+                    handle_client_connection(stream, state);
                 });
             }
             Err(e) => {
-                eprintln!("Connection error: {}", e);
+                error!("Connection error: {}", e);
             }
         }
     }
@@ -258,137 +1222,338 @@ fn request_listener(request_tx: Sender<(Request, UnixStream)>) -> Result<()> {
     Ok(())
 }
 
-/// Connection acceptor thread - accepts connections on response sockets
-fn connection_acceptor(state: Arc<Mutex<ServiceState>>) -> Result<()> {
-    println!("Connection acceptor thread started");
+/// Whether an event can change file contents. Metadata-only changes and
+/// access events (opens, reads, closes) never do, except closing a file that
+/// was open for writing: inotify reports each `write()` as it happens, so a
+/// reload triggered by one can see a half-written file, and the close is the
+/// first point where the writer's data is guaranteed to be complete.
+fn changes_contents(kind: &EventKind) -> bool {
+    match kind {
+        EventKind::Access(AccessKind::Close(AccessMode::Write)) => true,
+        EventKind::Access(_) | EventKind::Modify(ModifyKind::Metadata(_)) => false,
+        _ => true,
+    }
+}
+
+/// Snapshot of every loaded codebase, so the watcher can reload files without
+/// holding the state lock and blocking searches
+fn loaded_codebases(state: &Mutex<ServiceState>) -> Vec<(PathBuf, Arc<RwLock<MmapCache>>)> {
+    state
+        .lock()
+        .unwrap()
+        .roots
+        .iter()
+        .map(|(root, shared)| (root.clone(), Arc::clone(&shared.cache)))
+        .collect()
+}
+
+/// Watcher thread - applies file system events to every codebase whose root
+/// contains the changed path.
+///
+/// A single save shows up as several events (create, each write, close), so
+/// changed paths are collected for `DEBOUNCE` after their first event and then
+/// reloaded once. `refresh` reads the current state of a path rather than the
+/// event kinds, so coalescing loses nothing. The window is not extended by
+/// later events, so a file that is written continuously is still reloaded.
+fn watch_worker(event_rx: Receiver<notify::Result<Event>>, state: Arc<Mutex<ServiceState>>) -> Result<()> {
+    info!("Watcher thread started");
+
+    // Changed paths in the order they are due to be reloaded, and the same
+    // paths as a set. Every deadline is the arrival time plus `DEBOUNCE`, so
+    // the queue is sorted by deadline and due paths are taken from the front.
+    let mut pending: VecDeque<(Instant, PathBuf)> = VecDeque::new();
+    let mut queued: HashSet<PathBuf> = HashSet::new();
 
     loop {
-        let mut state = state.lock().unwrap();
+        let received = match pending.front() {
+            Some(&(deadline, _)) => event_rx.recv_deadline(deadline),
+            None => event_rx.recv().map_err(|_| RecvTimeoutError::Disconnected),
+        };
 
-        // Check all listeners for pending connections
-        let mut connections = Vec::new();
-        for (&pid, listener) in &state.response_listeners {
-            match listener.accept() {
-                Ok((stream, _)) => {
-                    println!("[PID {}] Client connected successfully", pid);
-                    connections.push((pid, stream));
-                }
-                Err(ref e) if e.kind() == std::io::ErrorKind::WouldBlock => {
-                    // No pending connection, continue
+        match received {
+            Ok(Ok(event)) if event.need_rescan() => {
+                // The watcher dropped events, so individual changes are unknown
+                pending.clear();
+                queued.clear();
+                for (root, cache) in loaded_codebases(&state) {
+                    match MmapCache::new(&root) {
+                        Ok(fresh) => {
+                            *cache.write().unwrap() = fresh;
+                            state.lock().unwrap().publish(&root, &[WatchEvent::Rescanned]);
+                        }
+                        Err(e) => error!("Failed to reload codebase {}: {}", root.display(), e),
+                    }
                 }
-                Err(e) => {
-                    eprintln!("[PID {}] Error accepting connection: {}", pid, e);
+                continue;
+            }
+            Ok(Ok(event)) => {
+                if changes_contents(&event.kind) {
+                    let deadline = Instant::now() + DEBOUNCE;
+                    for path in event.paths {
+                        if queued.insert(path.clone()) {
+                            pending.push_back((deadline, path));
+                        }
+                    }
                 }
             }
+            Ok(Err(e)) => error!("Watch error: {}", e),
+            Err(RecvTimeoutError::Timeout) => {}
+            Err(RecvTimeoutError::Disconnected) => break,
         }
 
-        if !connections.is_empty() {
-            println!("Accepted {} connections", connections.len());
+        let now = Instant::now();
+        let mut due = Vec::new();
+        while let Some((deadline, _)) = pending.front() {
+            if *deadline > now {
+                break;
+            }
+            let (_, path) = pending.pop_front().unwrap();
+            queued.remove(&path);
+            due.push(path);
         }
-
-        // Apply connections to state
-        for (pid, stream) in connections {
-            state.response_sockets.insert(pid, stream);
-            state.response_listeners.remove(&pid);
+        if due.is_empty() {
+            continue;
         }
+        // Parents before children, for a predictable order
+        due.sort_unstable();
 
-        drop(state); // Release lock
+        // The due paths are checked against the stored contents in parallel,
+        // under each codebase's read lock, so searches keep running. Only the
+        // files that really changed are reloaded, here on the watcher thread:
+        // a rayon task waiting for a write lock could hold up searches that
+        // need the pool to finish and release their read locks.
+        let codebases = loaded_codebases(&state);
+        let stale: Vec<Vec<&PathBuf>> = codebases
+            .par_iter()
+            .map(|(root, cache)| {
+                let cache = cache.read().unwrap();
+                due.par_iter()
+                    .filter(|path| path.starts_with(root) && cache.is_stale(path))
+                    .collect()
+            })
+            .collect();
 
-        // No sleep - poll continuously for connections
-        // This ensures we accept connections as soon as they arrive
+        for ((root, cache), stale) in codebases.iter().zip(stale) {
+            let mut events = Vec::new();
+            for path in stale {
+                // One file per write lock, so searches wait for a single
+                // reload rather than the whole batch
+                let changes = cache.write().unwrap().refresh_stale(path);
+                if !changes.is_empty() {
+                    debug!("Reloaded {}", path.display());
+                }
+                events.extend(changes.into_iter().map(WatchEvent::from));
+            }
+            if !events.is_empty() {
+                state.lock().unwrap().publish(root, &events);
+            }
+        }
     }
+
+    Ok(())
 }
 
-/// Main worker thread - processes requests from queue
-fn request_worker(request_rx: Receiver<(Request, UnixStream)>, state: Arc<Mutex<ServiceState>>) -> Result<()> {
-    println!("Worker thread started");
+/// Answer a subscribe_events request, then forward file events for the PID's
+/// codebase to the client until it disconnects or the codebase is freed
+fn stream_events(
+    state: &Mutex<ServiceState>,
+    req_id: Option<u64>,
+    pid: u32,
+    mut stream: &UnixStream,
+    out: &mut Vec<u8>,
+) {
+    let subscription = {
+        let mut state = state.lock().unwrap();
+        state.codebases.get(&pid).cloned().map(|root| {
+            let (id, events) = state.subscribe(root.clone());
+            (root, id, events)
+        })
+    };
 
+    let mut response = match &subscription {
+        Some(_) => Response::success(Some("Subscribed to file events".to_string())),
+        None => no_codebase(pid),
+    };
+    response.req_id = req_id;
+    if write_response(&mut stream, &response, out).is_err() {
+        return;
+    }
+    let Some((root, id, events)) = subscription else {
+        return;
+    };
+
+    info!("[PID {}] Subscribed to file events", pid);
     loop {
-        match request_rx.recv() {
-            Ok((request, stream)) => {
-                let mut state = state.lock().unwrap();
+        // A quiet codebase sends nothing, so a client that hung up is only
+        // noticed by checking the socket
+        let event = match events.recv_timeout(HANGUP_CHECK_INTERVAL) {
+            Ok(event) => event,
+            Err(RecvTimeoutError::Timeout) if peer_closed(stream) => break,
+            Err(RecvTimeoutError::Timeout) => continue,
+            // The codebase was freed
+            Err(RecvTimeoutError::Disconnected) => return,
+        };
+        if let Err(e) = encode_frame(&event, out) {
+            error!("[PID {}] Failed to encode event: {}", pid, e);
+            continue;
+        }
+        if write_frame(&mut stream, out).is_err() {
+            break;
+        }
+    }
+    state.lock().unwrap().unsubscribe(&root, id);
+}
 
-                let (pid, response, is_alloc_pid) = match &request {
-                    Request::AllocPid { pid, repo_dir_path } => {
-                        (*pid, handle_alloc_pid(&mut state, *pid, repo_dir_path.clone()), true)
-                    }
-                    Request::RequestRipgrep {
-                        pid,
-                        pattern,
-                        case_sensitive,
-                    } => (*pid, handle_ripgrep(&state, *pid, pattern.clone(), *case_sensitive), false),
-                };
+/// Whether the client on the other end of an event stream has hung up.
+/// Clients send nothing on an event stream, so it is only readable once the
+/// client has closed it.
+fn peer_closed(stream: &UnixStream) -> bool {
+    let mut byte = 0u8;
+    let read = unsafe {
+        libc::recv(
+            stream.as_raw_fd(),
+            &mut byte as *mut u8 as *mut libc::c_void,
+            1,
+            libc::MSG_PEEK | libc::MSG_DONTWAIT,
+        )
+    };
+    match read {
+        0 => true,
+        n if n > 0 => false,
+        _ => std::io::Error::last_os_error().kind() != ErrorKind::WouldBlock,
+    }
+}
 
-                match response {
-                    Ok(resp) => {
-                        if is_alloc_pid {
-                            // For alloc_pid, send response directly on the request stream
-                            if let Err(e) = send_response_on_stream(&mut stream.try_clone()?, &resp) {
-                                eprintln!("[PID {}] Failed to send alloc_pid response: {}", pid, e);
-                                // Clean up failed allocation
-                                state.response_sockets.remove(&pid);
-                                state.response_listeners.remove(&pid);
-                                state.codebases.remove(&pid);
-                            }
-                        } else {
-                            // For other requests, send on response socket
-                            if let Err(e) = send_response(&mut state, pid, &resp) {
-                                eprintln!("[PID {}] Failed to send response: {}", pid, e);
-                                // Clean up dead socket
-                                state.response_sockets.remove(&pid);
-                                state.response_listeners.remove(&pid);
-                                state.codebases.remove(&pid);
-                            }
-                        }
-                    }
-                    Err(e) => {
-                        eprintln!("[PID {}] Request handler error: {}", pid, e);
-                    }
-                }
-            }
-            Err(e) => {
-                eprintln!("Channel receive error: {}", e);
-                break;
+/// Run one request and write its response to `stream`. Returns false once
+/// the connection should be closed: the client is gone, or the connection
+/// has become an event stream.
+fn handle_request(
+    state: &Mutex<ServiceState>,
+    envelope: Envelope,
+    mut stream: &UnixStream,
+    out: &mut Vec<u8>,
+) -> bool {
+    let Envelope { req_id, request } = envelope;
+
+    let (pid, response) = match &request {
+        Request::AllocPid { pid, repo_dir_path } => {
+            (*pid, handle_alloc_pid(state, *pid, repo_dir_path.clone()))
+        }
+        Request::RequestRipgrep {
+            pid,
+            pattern,
+            case_sensitive,
+            precompile,
+            binary,
+        } => (
+            *pid,
+            handle_ripgrep(
+                state,
+                req_id,
+                *pid,
+                pattern.clone(),
+                *case_sensitive,
+                *precompile,
+                *binary,
+            ),
+        ),
+        Request::RequestRipgrepCount {
+            pid,
+            pattern,
+            case_sensitive,
+        } => (
+            *pid,
+            handle_ripgrep_count(state, *pid, pattern, *case_sensitive),
+        ),
+        Request::RequestRipgrepMany {
+            pid,
+            patterns,
+            case_sensitive,
+        } => (
+            *pid,
+            handle_ripgrep_many(state, *pid, patterns, *case_sensitive),
+        ),
+        Request::SubscribeEvents { pid } => {
+            stream_events(state, req_id, *pid, stream, out);
+            return false;
+        }
+        Request::DeallocPid { pid } => (*pid, handle_dealloc_pid(state, *pid)),
+        Request::IndexEpoch { pid } => (*pid, handle_index_epoch(state, *pid)),
+    };
+
+    match response {
+        Ok(mut resp) => {
+            resp.req_id = req_id;
+            // Every response goes back on the connection the request came in on
+            if let Err(e) = write_response(&mut stream, &resp, out) {
+                error!("[PID {}] Failed to send response: {}", pid, e);
+                // The client is gone, so free its codebase
+                free_codebase(state, pid);
+                return false;
             }
         }
+        Err(e) => {
+            error!("[PID {}] Request handler error: {}", pid, e);
+        }
     }
 
-    Ok(())
+    true
 }
 
 fn main() -> Result<()> {
-    println!("{}", "=".repeat(80));
+    init_logging();
+
+    println!("{}", SEP);
     println!("CURSERVE Memory Search Service");
-    println!("{}", "=".repeat(80));
+    println!("{}", SEP);
     println!();
 
-    // Create shared state
-    let state = Arc::new(Mutex::new(ServiceState::new()));
-
-    // Create channel for communication between listener and worker
-    let (request_tx, request_rx) = bounded::<(Request, UnixStream)>(100);
-
-    // Spawn connection acceptor thread
-    let acceptor_state = Arc::clone(&state);
-    let acceptor_thread = thread::spawn(move || {
-        if let Err(e) = connection_acceptor(acceptor_state) {
-            eprintln!("Connection acceptor error: {}", e);
+    // Start the file watchers. Their events are handled on a thread of their
+    // own; the service still runs without them, it just will not see changes.
+    let (event_tx, event_rx) = unbounded::<notify::Result<Event>>();
+    let poll_tx = event_tx.clone();
+    let watcher = match notify::recommended_watcher(move |event| {
+        let _ = event_tx.send(event);
+    }) {
+        Ok(watcher) => Some(watcher),
+        Err(e) => {
+            warn!("Failed to start file watcher: {}", e);
+            None
         }
-    });
+    };
+    let poll_config = Config::default().with_poll_interval(POLL_INTERVAL);
+    let poller = match PollWatcher::new(
+        move |event| {
+            let _ = poll_tx.send(event);
+        },
+        poll_config,
+    ) {
+        Ok(poller) => Some(poller),
+        Err(e) => {
+            warn!("Failed to start polling watcher: {}", e);
+            None
+        }
+    };
+
+    // Create shared state
+    let state = Arc::new(Mutex::new(ServiceState::new(Watchers {
+        native: watcher,
+        poller,
+    })));
 
     // Spawn listener thread
-    let listener_tx = request_tx.clone();
+    let listener_state = Arc::clone(&state);
     let listener_thread = thread::spawn(move || {
-        if let Err(e) = request_listener(listener_tx) {
-            eprintln!("Request listener error: {}", e);
+        if let Err(e) = request_listener(listener_state) {
+            error!("Request listener error: {}", e);
         }
     });
 
-    // Spawn worker thread
-    let worker_state = Arc::clone(&state);
-    let worker_thread = thread::spawn(move || {
-        if let Err(e) = request_worker(request_rx, worker_state) {
-            eprintln!("Request worker error: {}", e);
+    // Spawn watcher thread
+    let watch_state = Arc::clone(&state);
+    let watch_thread = thread::spawn(move || {
+        if let Err(e) = watch_worker(event_rx, watch_state) {
+            error!("Watcher error: {}", e);
         }
     });
 
@@ -397,11 +1562,10 @@ fn main() -> Result<()> {
 
     // Wait for threads
     listener_thread.join().expect("Listener thread panicked");
-    worker_thread.join().expect("Worker thread panicked");
-    acceptor_thread.join().expect("Acceptor thread panicked");
+    watch_thread.join().expect("Watcher thread panicked");
 
     // Cleanup
-    let _ = fs::remove_file(REQUEST_SOCKET);
+    unlink_socket(REQUEST_SOCKET);
 
     Ok(())
 }
@@ -0,0 +1,405 @@
+//! Trigram index used to skip buffers that cannot contain a pattern's literals.
+//!
+//! Text is folded before indexing: ASCII letters are lowercased, and the two
+//! non-ASCII characters that case-fold to ASCII letters (U+017F LATIN SMALL
+//! LETTER LONG S and U+212A KELVIN SIGN) map to `s` and `k`. Query literals
+//! are folded the same way, so one index serves both case-sensitive and
+//! case-insensitive searches.
+
+use regex_syntax::hir::{Class, Hir, HirKind};
+use std::collections::HashMap;
+
+/// Compact the scratch list of trigrams once it holds this many entries, so
+/// indexing a large buffer never needs memory proportional to its size
+const COMPACT_THRESHOLD: usize = 1 << 20;
+
+/// Most bytes of text that fold to a single byte (U+212A KELVIN SIGN)
+pub const MAX_FOLDED_CHAR_BYTES: usize = 3;
+
+/// Call `f` with each folded byte of `bytes`
+fn for_each_folded(bytes: &[u8], mut f: impl FnMut(u8)) {
+    let mut i = 0;
+    while i < bytes.len() {
+        match bytes[i..] {
+            [0xC5, 0xBF, ..] => {
+                f(b's');
+                i += 2;
+            }
+            [0xE2, 0x84, 0xAA, ..] => {
+                f(b'k');
+                i += 3;
+            }
+            [b, ..] => {
+                f(b.to_ascii_lowercase());
+                i += 1;
+            }
+            [] => unreachable!(),
+        }
+    }
+}
+
+/// Fold a single character, if it folds to an ASCII byte
+fn fold_char(c: char) -> Option<u8> {
+    match c {
+        '\u{17F}' => Some(b's'),
+        '\u{212A}' => Some(b'k'),
+        c if c.is_ascii() => Some((c as u8).to_ascii_lowercase()),
+        _ => None,
+    }
+}
+
+/// Distinct folded trigrams of `bytes`, sorted
+pub fn trigrams(bytes: &[u8]) -> Vec<u32> {
+    let mut out = Vec::new();
+    let mut window = 0u32;
+    let mut seen = 0usize;
+
+    for_each_folded(bytes, |b| {
+        window = ((window << 8) | b as u32) & 0xFF_FFFF;
+        seen += 1;
+        if seen >= 3 {
+            out.push(window);
+            if out.len() >= COMPACT_THRESHOLD && out.len() == out.capacity() {
+                out.sort_unstable();
+                out.dedup();
+            }
+        }
+    });
+
+    out.sort_unstable();
+    out.dedup();
+    out
+}
+
+/// Literals (already folded) that every match of `pattern` must contain.
+///
+/// Returns an empty list when nothing useful can be proven, in which case the
+/// caller has to scan everything. Alternations and optional pieces are never
+/// mined, so the result is conservative: a buffer missing any returned
+/// literal cannot match.
+pub fn required_literals(pattern: &str, case_sensitive: bool) -> Vec<Vec<u8>> {
+    let hir = match regex_syntax::ParserBuilder::new()
+        .case_insensitive(!case_sensitive)
+        .build()
+        .parse(pattern)
+    {
+        Ok(hir) => hir,
+        Err(_) => return Vec::new(),
+    };
+
+    let mut runs = Vec::new();
+    let mut current = Vec::new();
+    collect_literals(&hir, &mut runs, &mut current);
+    flush(&mut runs, &mut current);
+
+    runs
+}
+
+/// End the current literal run, keeping it if it is long enough to index
+fn flush(runs: &mut Vec<Vec<u8>>, current: &mut Vec<u8>) {
+    if current.len() >= 3 {
+        runs.push(std::mem::take(current));
+    } else {
+        current.clear();
+    }
+}
+
+fn collect_literals(hir: &Hir, runs: &mut Vec<Vec<u8>>, current: &mut Vec<u8>) {
+    match hir.kind() {
+        HirKind::Literal(lit) => for_each_folded(&lit.0, |b| current.push(b)),
+        HirKind::Class(class) => match folded_class_byte(class) {
+            Some(b) => current.push(b),
+            None => flush(runs, current),
+        },
+        HirKind::Capture(cap) => collect_literals(&cap.sub, runs, current),
+        HirKind::Concat(subs) => {
+            for sub in subs {
+                collect_literals(sub, runs, current);
+            }
+        }
+        HirKind::Repetition(rep) => {
+            // The repeated piece is required if it must occur at least once,
+            // but it is not contiguous with what comes before or after it
+            flush(runs, current);
+            if rep.min > 0 {
+                collect_literals(&rep.sub, runs, current);
+                flush(runs, current);
+            }
+        }
+        HirKind::Empty | HirKind::Look(_) | HirKind::Alternation(_) => flush(runs, current),
+    }
+}
+
+/// If every character in a (small) class folds to the same byte, return it.
+/// This is how case-insensitive letters like `[eE]` or `[sSſ]` show up.
+fn folded_class_byte(class: &Class) -> Option<u8> {
+    let mut folded = None;
+    let mut count = 0;
+
+    let mut accept = |b: Option<u8>| -> Option<()> {
+        count += 1;
+        let b = b?;
+        if count > 4 || *folded.get_or_insert(b) != b {
+            return None;
+        }
+        Some(())
+    };
+
+    match class {
+        Class::Unicode(cls) => {
+            for range in cls.ranges() {
+                for c in range.start()..=range.end() {
+                    accept(fold_char(c))?;
+                }
+            }
+        }
+        Class::Bytes(cls) => {
+            for range in cls.ranges() {
+                for b in range.start()..=range.end() {
+                    accept(Some(b.to_ascii_lowercase()))?;
+                }
+            }
+        }
+    }
+
+    folded
+}
+
+/// Map from folded trigram to the (sorted) list of units containing it
+pub struct TrigramIndex {
+    postings: HashMap<u32, Vec<u32>>,
+}
+
+impl TrigramIndex {
+    pub fn new() -> Self {
+        Self {
+            postings: HashMap::new(),
+        }
+    }
+
+    /// Record a unit's trigrams. Adding units in increasing order is cheapest;
+    /// a unit that is out of order or already indexed (a shard that grew) is
+    /// inserted in place.
+    pub fn add(&mut self, unit: u32, trigrams: &[u32]) {
+        for &trigram in trigrams {
+            let units = self.postings.entry(trigram).or_default();
+            match units.last() {
+                Some(&last) if last >= unit => {
+                    if let Err(pos) = units.binary_search(&unit) {
+                        units.insert(pos, unit);
+                    }
+                }
+                _ => units.push(unit),
+            }
+        }
+    }
+
+    /// Units that contain every trigram of every literal, or `None` if the
+    /// literals are too short to narrow anything down
+    pub fn candidates(&self, literals: &[Vec<u8>]) -> Option<Vec<u32>> {
+        let mut lists: Vec<&[u32]> = Vec::new();
+        for literal in literals {
+            for window in literal.windows(3) {
+                let trigram = (window[0] as u32) << 16 | (window[1] as u32) << 8 | window[2] as u32;
+                match self.postings.get(&trigram) {
+                    Some(units) => lists.push(units),
+                    None => return Some(Vec::new()),
+                }
+            }
+        }
+
+        // Intersect starting from the rarest trigram
+        lists.sort_unstable_by_key(|units| units.len());
+        let (first, rest) = lists.split_first()?;
+        let mut result = first.to_vec();
+        for units in rest {
+            result.retain(|unit| units.binary_search(unit).is_ok());
+            if result.is_empty() {
+                break;
+            }
+        }
+
+        Some(result)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use regex::bytes::RegexBuilder;
+
+    /// Buffers the prefilter is checked against, one unit each
+    const UNITS: &[&str] = &[
+        "fn main() {\n    println!(\"hello world\");\n}\n",
+        "struct Point { x: i32 }\nimpl Point {}\n",
+        "STRUCT shouting\n",
+        "\u{17F}truct with a long s\n",
+        "\u{212A}elvin sign\n",
+        "kelvin plain\n",
+        "foo only\n",
+        "bar only\n",
+        "abababc\n",
+        "xxxx\n",
+        "hello, world\n",
+        "nothing to see\n",
+    ];
+
+    /// Units whose contents match `pattern`, by a full scan
+    fn full_scan(pattern: &str, case_sensitive: bool, units: &[&[u8]]) -> Vec<u32> {
+        let re = RegexBuilder::new(pattern)
+            .case_insensitive(!case_sensitive)
+            .multi_line(true)
+            .build()
+            .unwrap();
+        (0..units.len() as u32)
+            .filter(|&i| re.is_match(units[i as usize]))
+            .collect()
+    }
+
+    fn build_index(units: &[&[u8]]) -> TrigramIndex {
+        let mut index = TrigramIndex::new();
+        for (i, unit) in units.iter().enumerate() {
+            index.add(i as u32, &trigrams(unit));
+        }
+        index
+    }
+
+    /// Every unit a full scan matches must survive the prefilter
+    fn assert_prefilter_keeps_matches(
+        pattern: &str,
+        case_sensitive: bool,
+        index: &TrigramIndex,
+        units: &[&[u8]],
+    ) {
+        let literals = required_literals(pattern, case_sensitive);
+        let Some(candidates) = index.candidates(&literals) else {
+            return;
+        };
+        for unit in full_scan(pattern, case_sensitive, units) {
+            assert!(
+                candidates.contains(&unit),
+                "pattern {:?} (case_sensitive: {}) matches unit {} but the prefilter dropped it (literals {:?})",
+                pattern,
+                case_sensitive,
+                unit,
+                literals
+            );
+        }
+    }
+
+    #[test]
+    fn prefilter_keeps_every_match() {
+        let units: Vec<&[u8]> = UNITS.iter().map(|unit| unit.as_bytes()).collect();
+        let index = build_index(&units);
+
+        let patterns = [
+            "struct",
+            "STRUCT",
+            "\u{17F}truct",
+            "kelvin",
+            "\u{212A}elvin",
+            "KELVIN",
+            "foo|bar",
+            "(foo|bar) only",
+            "hello(,)? world",
+            "(ab){2}c",
+            "(?:ab){3}",
+            "x{3}",
+            "x{2,}",
+            "(hello) (world)",
+            "(?P<name>impl) Point",
+            "s[t]ruct",
+            "[sS]truct",
+            "fn \\w+",
+            "ab?c",
+            "^struct",
+            "sign$",
+            "n.thing",
+        ];
+        for pattern in patterns {
+            for case_sensitive in [false, true] {
+                assert_prefilter_keeps_matches(pattern, case_sensitive, &index, &units);
+            }
+        }
+    }
+
+    #[test]
+    fn special_folds_match_ascii_letters() {
+        let units: Vec<&[u8]> = UNITS.iter().map(|unit| unit.as_bytes()).collect();
+        let index = build_index(&units);
+
+        // Case-insensitive "struct" matches the long s, and "kelvin" the sign
+        let literals = required_literals("struct", false);
+        assert_eq!(index.candidates(&literals), Some(vec![1, 2, 3]));
+        let literals = required_literals("kelvin", false);
+        assert_eq!(index.candidates(&literals), Some(vec![4, 5]));
+
+        // Case-sensitive literals are folded too, so the candidates only
+        // narrow by folded trigrams; the matcher does the rest
+        assert_eq!(full_scan("struct", true, &units), vec![1]);
+        let literals = required_literals("struct", true);
+        assert!(index.candidates(&literals).unwrap().contains(&1));
+    }
+
+    #[test]
+    fn alternations_and_optional_pieces_are_not_required() {
+        assert!(required_literals("foo|bar", false).is_empty());
+        assert!(required_literals("(abc)?", false).is_empty());
+        assert!(required_literals("(abc)*", false).is_empty());
+        assert_eq!(required_literals("x(abc)+y", true), vec![b"abc".to_vec()]);
+        assert_eq!(required_literals("(abc){2}", true), vec![b"abc".to_vec()]);
+        assert_eq!(
+            required_literals("(hello) world", true),
+            vec![b"hello world".to_vec()]
+        );
+        assert_eq!(required_literals("Hello", true), vec![b"hello".to_vec()]);
+    }
+
+    #[test]
+    fn appended_tail_keeps_spanning_trigrams() {
+        // Indexing an append from two folded characters back, as
+        // `MmapCache::append_mapped` does, covers every trigram of the
+        // grown buffer, even when the old end is made of multibyte folds
+        let olds = ["ends in \u{212A}\u{212A}", "ends in \u{17F}\u{212A}", "ends in ab", "x"];
+        for old in olds {
+            let grown = format!("{}elvin and more", old);
+            let from = old.len().saturating_sub(2 * MAX_FOLDED_CHAR_BYTES);
+            let mut indexed = trigrams(old.as_bytes());
+            indexed.extend(trigrams(&grown.as_bytes()[from..]));
+            for trigram in trigrams(grown.as_bytes()) {
+                assert!(indexed.contains(&trigram), "{:?} lost trigram {:06x}", old, trigram);
+            }
+        }
+    }
+
+    #[test]
+    fn shard_member_boundaries() {
+        // A shard gets a member appended and only the new tail indexed, the
+        // way `MmapCache::index_unit` does after a refresh
+        let first = b"ends with struc\n".as_slice();
+        let second = b"tstarts here\nlast line no newline".as_slice();
+        let shard = [first, second].concat();
+
+        let mut index = TrigramIndex::new();
+        index.add(0, &trigrams(first));
+        index.add(0, &trigrams(&shard[first.len()..]));
+        let units = [shard.as_slice()];
+
+        for pattern in [
+            "struc",
+            "tstarts",
+            "^tstarts here$",
+            "no newline",
+            "newline$",
+            "ends with",
+        ] {
+            for case_sensitive in [false, true] {
+                assert_prefilter_keeps_matches(pattern, case_sensitive, &index, &units);
+            }
+        }
+
+        // Matches cannot span the member boundary, so a trigram across it is
+        // never needed
+        assert!(full_scan("struct", false, &units).is_empty());
+    }
+}